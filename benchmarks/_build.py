@@ -0,0 +1,23 @@
+import os
+import sys
+import importlib
+import tempfile
+from setuptools import Distribution
+from promisedio_buildtools.extension import Extension, build_ext
+
+
+def build_extension(name, sources, build_dir=None, **kwargs):
+    """Build an extension in build_dir (a temporary directory by default) and import it."""
+    build_dir = build_dir or tempfile.mkdtemp(prefix=f"{name}-")
+    sources = [os.path.abspath(source) for source in sources]
+    dist = Distribution({"name": name, "ext_modules": [Extension(name, sources, **kwargs)]})
+    cmd = build_ext(dist)
+    cmd.build_lib = build_dir
+    cmd.build_temp = os.path.join(build_dir, "temp")
+    cmd.ensure_finalized()
+    cmd.run()
+    sys.path.insert(0, build_dir)
+    try:
+        return importlib.import_module(name)
+    finally:
+        sys.path.remove(build_dir)
@@ -0,0 +1,84 @@
+"""Replay a synthetic MEMLOG trace through memcheck and check it scales linearly.
+
+The trace keeps a tenth of its allocations alive and frees them in FIFO
+order, the worst case for a list based live set. It is generated on the
+fly, so memory stays flat. Usage:
+
+    python benchmarks/memcheck_replay.py [--events 10000000] [--tolerance 2.0]
+"""
+import sys
+import time
+import argparse
+from promisedio_buildtools.memcheck import Processes, read_chunks
+
+
+class SyntheticTrace:
+    """File-like object producing a text trace of `events` MEMLOG events."""
+
+    def __init__(self, events):
+        self.events = events
+        self.generator = self.generate()
+        self.buffer = b""
+
+    def generate(self):
+        live = max(self.events // 10, 1)
+        site = " -- bench.c:1, bench"
+        emitted = 0
+        addr = 0
+        while emitted < self.events:
+            lines = []
+            for _ in range(1000):
+                # Malloc a new block, free the oldest one once the window is full
+                lines.append(f"#Malloc({addr:#x}, RAW, 64){site}")
+                if addr >= live:
+                    lines.append(f"#Free({addr - live:#x}, RAW){site}")
+                # A short object lifecycle
+                obj = 0x10000000000 + addr
+                lines.append(f"#New({obj:#x}, Bench, 32){site}")
+                lines.append(f"#Incref({obj:#x}, Bench){site}")
+                lines.append(f"#Decref({obj:#x}, Bench){site}")
+                lines.append(f"#Delete({obj:#x}, Bench){site}")
+                addr += 1
+            emitted += len(lines)
+            yield ("\n".join(lines) + "\n").encode()
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            chunk = next(self.generator, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def replay(events):
+    processes = Processes(default="bench")
+    start = time.perf_counter()
+    read_chunks(processes, SyntheticTrace(events))
+    elapsed = time.perf_counter() - start
+    return elapsed, processes.get().events
+
+
+def main(params=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=10_000_000, help="events of the largest run")
+    parser.add_argument(
+        "--tolerance", type=float, default=2.0,
+        help="allowed ratio between the slowest and fastest per-event time"
+    )
+    args = parser.parse_args(params)
+    per_event = []
+    for fraction in (8, 4, 2, 1):
+        elapsed, events = replay(args.events // fraction)
+        per_event.append(elapsed / events * 1e6)
+        print(f"{events:>10} events: {elapsed:7.2f}s, {per_event[-1]:.2f} us/event")
+    ratio = max(per_event) / min(per_event)
+    print(f"per-event time ratio: {ratio:.2f}")
+    if ratio > args.tolerance:
+        print(f"not linear: ratio exceeds {args.tolerance}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Compare cold builds of an extension with and without precompiled headers.
+
+The extension has --sources C files that all include promisedio.h, each
+build starts from an empty build directory. Usage:
+python benchmarks/precompiled_header.py [--sources N] [--repeat N]
+"""
+import os
+import time
+import argparse
+import tempfile
+from _build import build_extension
+
+MODULE_SOURCE = """\
+#include "promisedio.h"
+
+static PyModuleDef _module_def = {
+    PyModuleDef_HEAD_INIT,
+    .m_name = "pch_bench",
+};
+
+PyMODINIT_FUNC
+PyInit_pch_bench(void)
+{
+    return PyModuleDef_Init(&_module_def);
+}
+"""
+
+SOURCE = """\
+#include "promisedio.h"
+
+int
+pch_bench_%d(void)
+{
+    return %d;
+}
+"""
+
+
+def write_sources(directory, count):
+    sources = [os.path.join(directory, "pch_bench.c")]
+    with open(sources[0], "wt") as f:
+        f.write(MODULE_SOURCE)
+    for i in range(1, count):
+        sources.append(os.path.join(directory, f"pch_bench_{i}.c"))
+        with open(sources[-1], "wt") as f:
+            f.write(SOURCE % (i, i))
+    return sources
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sources", type=int, default=16, help="number of C sources")
+    parser.add_argument("--repeat", type=int, default=3, help="builds per variant, the fastest one is reported")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        sources = write_sources(directory, args.sources)
+        results = {}
+        for _ in range(args.repeat):
+            for precompiled_header in (False, True):
+                build_dir = tempfile.mkdtemp(dir=directory)
+                start = time.perf_counter()
+                build_extension(
+                    "pch_bench", sources, build_dir,
+                    define_macros=[("Py_BUILD_CORE", 1)],
+                    precompiled_header=precompiled_header
+                )
+                elapsed = time.perf_counter() - start
+                results[precompiled_header] = min(results.get(precompiled_header, elapsed), elapsed)
+    print(f"{args.sources} sources: {results[False]:.2f} s without, {results[True]:.2f} s with precompiled header")
+
+
+if __name__ == "__main__":
+    main()
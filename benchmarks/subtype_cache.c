@@ -0,0 +1,88 @@
+#include "promisedio.h"
+
+typedef struct {
+    PyObject *BaseType;
+} _modulestate;
+
+static PyModuleDef _module_def;
+
+static PyObject *
+cached(PyObject *self, PyObject *args)
+{
+    Py_ssize_t n;
+    if (!PyArg_ParseTuple(args, "n", &n)) {
+        return NULL;
+    }
+    for (Py_ssize_t i = 0; i < n; i++) {
+        _CTX_set_subtype(Py_TYPE(self), &_module_def);
+        if (!_ctx) {
+            return NULL;
+        }
+    }
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+uncached(PyObject *self, PyObject *args)
+{
+    Py_ssize_t n;
+    if (!PyArg_ParseTuple(args, "n", &n)) {
+        return NULL;
+    }
+    for (Py_ssize_t i = 0; i < n; i++) {
+        _ctx_var = _CTX_get_module(_CTX__GetModuleByDef(Py_TYPE(self), &_module_def));
+        if (!_ctx) {
+            return NULL;
+        }
+    }
+    Py_RETURN_NONE;
+}
+
+static PyMethodDef base_methods[] = {
+    {"cached", cached, METH_VARARGS},
+    {"uncached", uncached, METH_VARARGS},
+    {NULL}
+};
+
+static PyType_Slot base_slots[] = {
+    {Py_tp_methods, base_methods},
+    {0, 0}
+};
+
+static PyType_Spec base_spec = {
+    "subtype_cache.Base",
+    sizeof(PyObject),
+    0,
+    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE,
+    base_slots
+};
+
+static int
+module_exec(PyObject *module)
+{
+    _CTX_set_module(module);
+    S(BaseType) = PyType_FromModuleAndSpec(module, &base_spec, NULL);
+    if (!S(BaseType)) {
+        return -1;
+    }
+    Py_INCREF(S(BaseType));
+    return PyModule_AddObject(module, "Base", S(BaseType));
+}
+
+static PyModuleDef_Slot module_slots[] = {
+    {Py_mod_exec, module_exec},
+    {0, NULL}
+};
+
+static PyModuleDef _module_def = {
+    PyModuleDef_HEAD_INIT,
+    .m_name = "subtype_cache",
+    .m_size = sizeof(_modulestate),
+    .m_slots = module_slots,
+};
+
+PyMODINIT_FUNC
+PyInit_subtype_cache(void)
+{
+    return PyModuleDef_Init(&_module_def);
+}
@@ -0,0 +1,34 @@
+"""Compare cached and uncached module state lookups of subtypes.
+
+_CTX_get_subtype goes through a per-type cache, the uncached path walks
+the MRO with PyType_GetModuleByDef. Usage: python benchmarks/subtype_cache.py
+"""
+import os
+import time
+from _build import build_extension
+
+N = 1_000_000
+
+
+def main():
+    module = build_extension(
+        "subtype_cache",
+        [os.path.join(os.path.dirname(__file__), "subtype_cache.c")],
+        define_macros=[("Py_BUILD_CORE", 1)]
+    )
+    cls = module.Base
+    for depth in (1, 4, 16):
+        cls = type(f"Sub{depth}", (cls,), {})
+        while len(cls.__mro__) - 2 < depth:
+            cls = type(f"Sub{depth}", (cls,), {})
+        obj = cls()
+        results = []
+        for method in (obj.uncached, obj.cached):
+            start = time.perf_counter()
+            method(N)
+            results.append((time.perf_counter() - start) / N * 1e9)
+        print(f"depth {depth:2}: uncached {results[0]:6.1f} ns, cached {results[1]:6.1f} ns")
+
+
+if __name__ == "__main__":
+    main()
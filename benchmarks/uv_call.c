@@ -0,0 +1,76 @@
+#include "promisedio_uv.h"
+
+static uv_loop_t loop;
+static uv_timer_t timer;
+
+static void
+timer_cb(uv_timer_t *handle)
+{
+}
+
+// Start and stop a timer n times, the kind of call UV_CALL_FAST is meant for
+#define TIMER_BENCH(name, CALL)                                 \
+static PyObject *                                               \
+name(PyObject *module, PyObject *args)                          \
+{                                                               \
+    Py_ssize_t n;                                               \
+    if (!PyArg_ParseTuple(args, "n", &n)) {                     \
+        return NULL;                                            \
+    }                                                           \
+    for (Py_ssize_t i = 0; i < n; i++) {                        \
+        {                                                       \
+            CALL(uv_timer_start, &timer, timer_cb, 1000, 0) {   \
+                Py_SetUVError(PyExc_OSError, uv_errno);         \
+                return NULL;                                    \
+            }                                                   \
+        }                                                       \
+        {                                                       \
+            CALL(uv_timer_stop, &timer) {                       \
+                Py_SetUVError(PyExc_OSError, uv_errno);         \
+                return NULL;                                    \
+            }                                                   \
+        }                                                       \
+    }                                                           \
+    Py_RETURN_NONE;                                             \
+}
+
+TIMER_BENCH(uv_call, UV_CALL)
+TIMER_BENCH(uv_call_fast, UV_CALL_FAST)
+
+static PyMethodDef module_methods[] = {
+    {"uv_call", uv_call, METH_VARARGS},
+    {"uv_call_fast", uv_call_fast, METH_VARARGS},
+    {NULL}
+};
+
+static int
+module_exec(PyObject *module)
+{
+    int uv_errno = uv_loop_init(&loop);
+    if (uv_errno >= 0) {
+        uv_errno = uv_timer_init(&loop, &timer);
+    }
+    if (uv_errno < 0) {
+        Py_SetUVError(PyExc_OSError, uv_errno);
+        return -1;
+    }
+    return 0;
+}
+
+static PyModuleDef_Slot module_slots[] = {
+    {Py_mod_exec, module_exec},
+    {0, NULL}
+};
+
+static PyModuleDef _module_def = {
+    PyModuleDef_HEAD_INIT,
+    .m_name = "uv_call",
+    .m_methods = module_methods,
+    .m_slots = module_slots,
+};
+
+PyMODINIT_FUNC
+PyInit_uv_call(void)
+{
+    return PyModuleDef_Init(&_module_def);
+}
@@ -0,0 +1,55 @@
+"""Compare libuv calls made with UV_CALL (releases the GIL) and UV_CALL_FAST (keeps it).
+
+Each iteration starts and stops a timer. With --threads, Python threads
+compete for the GIL: a thread that releases it around a short call then
+has to wait for it to come back, which is the cost UV_CALL_FAST avoids.
+Needs the libuv headers and library.
+Usage: python benchmarks/uv_call.py [--threads N]
+"""
+import os
+import time
+import argparse
+import threading
+from _build import build_extension
+
+N = 1_000_000
+# GIL handoffs take up to sys.getswitchinterval() each
+N_CONTENDED = 200
+
+
+def spin(stop):
+    while not stop.is_set():
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=1, help="number of threads competing for the GIL")
+    args = parser.parse_args()
+    module = build_extension(
+        "uv_call",
+        [os.path.join(os.path.dirname(__file__), "uv_call.c")],
+        define_macros=[("Py_BUILD_CORE", 1)],
+        libraries=["uv"]
+    )
+    for threads in sorted({0, args.threads}):
+        n = N_CONTENDED if threads else N
+        stop = threading.Event()
+        workers = [threading.Thread(target=spin, args=(stop,)) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        results = []
+        try:
+            for func in (module.uv_call, module.uv_call_fast):
+                start = time.perf_counter()
+                func(n)
+                results.append((time.perf_counter() - start) / n / 2 * 1e9)
+        finally:
+            stop.set()
+            for worker in workers:
+                worker.join()
+        print(f"{threads} competing threads: UV_CALL {results[0]:10.1f} ns, UV_CALL_FAST {results[1]:8.1f} ns per call")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@ import os
 import re
 import hashlib
 import argparse
+from .cppscan import Monitor, add_macro_arguments, get_macros
 
 
 CODE_HEADER = "// Auto-generated\n\n"
@@ -178,20 +179,22 @@ class Context:
 def main(params=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("root")
+    add_macro_arguments(parser)
     args = parser.parse_args(params)
+    macros = get_macros(args)
     for dirname, dirs, files in os.walk(args.root):
         for filename in files:
             module, ext = os.path.splitext(filename)
             if ext != ".c":
                 continue
             module_path = os.path.join(dirname, filename)
-            generate_capsule(module, module_path, dirname)
+            generate_capsule(module, module_path, dirname, macros)
 
 
-def generate_capsule(module, module_path, dirname):
+def generate_capsule(module, module_path, dirname, macros=None):
     with open(module_path, "rt") as f:
         module_source = f.read()
-    instructions, errors = parse_c_file(module_source)
+    instructions, errors = parse_c_file(module_source, macros)
     if errors:
         for msg, line, extra in errors:
             extra = f": {extra}" if extra else ""
@@ -271,16 +274,25 @@ def generate_capsule(module, module_path, dirname):
         print("  No changes")
 
 
-def parse_c_file(source):
+def parse_c_file(source, macros=None):
     errors = []
     instructions = []
 
-    for index, match in enumerate(re.finditer(r"CAPSULE_API\s*\((.*)\)([^{;]*)", source)):
+    monitor = None
+    if macros is not None:
+        monitor = Monitor(macros=macros)
+        monitor.scan(source)
+
+    index = 0
+    for match in re.finditer(r"CAPSULE_API\s*\((.*)\)([^{;]*)", source):
         start, end = match.span()
+        if monitor and monitor.disabled_at(source.count("\n", 0, start) + 1):
+            continue
         try:
             instructions.append(
                 FunctionInstruction(start, end, match.groups(), index)
             )
+            index += 1
         except ValueError as e:
             errors.append((
                 e.args[0],
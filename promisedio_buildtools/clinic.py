@@ -1,15 +1,20 @@
 import re
 import sys
-from . import cpp
+import argparse
+from . import cppscan
 
-sys.modules["cpp"] = sys.modules["promisedio_buildtools.cpp"]
+sys.modules["cpp"] = sys.modules["promisedio_buildtools.cppscan"]
 
 from . pyclinic import *
 from . pyclinic import main as clinic_main
+from . import pyclinic
 
 
 readme_contents = {}
 
+# Macros of the target platform, blocks that are statically disabled for them are not generated
+target_macros = None
+
 format_to_signature = {
     "s": "str",                                 # [const char *]
     "s*": "Union[str, bytes, bytearray]",       # [Py_buffer]
@@ -74,10 +79,16 @@ def get_return_annotation(func):
     return annotation or "Any"
 
 
+_CLanguage_init = CLanguage.__init__
 _CLanguage_docstring_for_c_string = CLanguage.docstring_for_c_string
 _CLanguage_output_templates = CLanguage.output_templates
 
 
+def CLanguage_init(self, filename):
+    _CLanguage_init(self, filename)
+    self.cpp.macros = target_macros
+
+
 def CLanguage_docstring_for_c_string(self, f):
     result = _CLanguage_docstring_for_c_string(self, f)
     module = readme_contents.setdefault(f.module.name, {"classes": {}, "functions": {}})
@@ -120,9 +131,25 @@ def CLanguage_output_templates(self, f):
                     "_ctx, {impl_arguments}"
                 )
                 break
+    if self.cpp.is_disabled():
+        # The block output doesn't depend on the target macros (it is checksummed),
+        # drop only what goes to other buffers and files, except the empty
+        # METHODDEF define the method tables rely on
+        return {
+            name: value if name == "methoddef_ifndef" or goes_to_block(name) else ""
+            for name, value in result.items()
+        }
     return result
 
 
+def goes_to_block(name):
+    destination = pyclinic.clinic.destination_buffers[name]
+    block = pyclinic.clinic.get_destination("block")
+    # "output <name> block" stores the destination itself, presets store its buffer
+    return destination is block or destination is block.buffers[0]
+
+
+CLanguage.__init__ = CLanguage_init
 CLanguage.docstring_for_c_string = CLanguage_docstring_for_c_string
 CLanguage.output_templates = CLanguage_output_templates
 
@@ -227,6 +254,33 @@ class Py_ssize_t_return_converter(Py_ssize_t_return_converter):
     typed = "int"
 
 
+README_MARKER = re.compile(
+    r"<!---\s*template:\[(?P<template>[\w.]+)\]\s*(?P<classes>.*?)-->"
+    r"|<!---\s*end:\[(?P<end>[\w.]+)\]\s*-->",
+    re.DOTALL
+)
+
+
+def parse_readme(template):
+    """Split the README into text pieces and (module, classes) template sections."""
+    pieces = []
+    pos = 0
+    opened = None
+    for match in README_MARKER.finditer(template):
+        if match.group("template"):
+            # A template marker without its end marker is left as text
+            opened = match
+            continue
+        if opened is None or match.group("end") != opened.group("template"):
+            continue
+        pieces.append(template[pos:opened.start()])
+        pieces.append((opened.group("template"), opened.group("classes").split(), template[opened.start():match.end()]))
+        pos = match.end()
+        opened = None
+    pieces.append(template[pos:])
+    return pieces
+
+
 def generate_readme():
 
     def replacer(m):
@@ -251,14 +305,24 @@ def generate_readme():
         output.append(f"#### {name}")
         generate_descr(name, f)
 
-    for module in sorted(readme_contents):
-        template = open("README.md").read()
-        pattern = rf"<!---\s*template:\[{module}\]\s*([\S\s]*?)(?=-->)-->[\s\S]*<!---\s*end:\[{module}\]\s*-->"
-        match = re.search(pattern, template)
-        if not match:
-            print(f"<!--- template:[{module}] --> missing")
+    if not readme_contents:
+        return
+    with open("README.md", "rt") as f:
+        template = f.read()
+    pieces = parse_readme(template)
+    sections = {piece[0] for piece in pieces if isinstance(piece, tuple)}
+    for module in sorted(set(readme_contents) - sections):
+        print(f"<!--- template:[{module}] --> missing")
+
+    result = []
+    for piece in pieces:
+        if isinstance(piece, str):
+            result.append(piece)
+            continue
+        module, sorted_classes, original = piece
+        if module not in readme_contents:
+            result.append(original)
             continue
-        sorted_classes = match.group(1).split()
         output = []
         classes = readme_contents[module]["classes"]
         functions = readme_contents[module]["functions"]
@@ -277,26 +341,27 @@ def generate_readme():
                 generate_function(f"{cls}.{function}", functions[function])
         output.append("")
 
-        def repl(m):
-            items = "\n".join(m.group(1).split())
-            out = ""
-            if items:
-                out += f"<!--- template:[{module}]\n{items}\n-->\n"
-            else:
-                out += f"<!--- template:[{module}] -->\n"
-            return (
-                out +
-                "\n".join(output) +
-                f"\n<!--- end:[{module}] -->"
-            )
+        items = "\n".join(sorted_classes)
+        if items:
+            result.append(f"<!--- template:[{module}]\n{items}\n-->\n")
+        else:
+            result.append(f"<!--- template:[{module}] -->\n")
+        result.append("\n".join(output))
+        result.append(f"\n<!--- end:[{module}] -->")
 
-        result = re.sub(pattern, repl, template, 1, re.MULTILINE)
-        if result != template:
-            open("README.md", "wt").write(result)
+    result = "".join(result)
+    if result != template:
+        with open("README.md", "wt") as f:
+            f.write(result)
 
 
 def main():
-    clinic_main(sys.argv[1:])
+    global target_macros
+    parser = argparse.ArgumentParser(add_help=False)
+    cppscan.add_macro_arguments(parser)
+    args, argv = parser.parse_known_args(sys.argv[1:])
+    target_macros = cppscan.get_macros(args)
+    clinic_main(argv)
     generate_readme()
 
 
@@ -0,0 +1,320 @@
+import re
+import sys
+import sysconfig
+from bisect import bisect_right
+from .cpp import *
+from .cpp import Monitor as _Monitor
+
+
+# Binary operators and their precedence
+BINARY_OPERATORS = {
+    "||": 1, "&&": 2, "|": 3, "^": 4, "&": 5,
+    "==": 6, "!=": 6, "<": 7, ">": 7, "<=": 7, ">=": 7,
+    "<<": 8, ">>": 8, "+": 9, "-": 9, "*": 10, "/": 10, "%": 10,
+}
+
+TOKEN = re.compile(r"""
+    \s*(?:
+        (?P<number>0[xX][0-9a-fA-F]+|\d+)[uUlL]*
+        |(?P<name>[A-Za-z_]\w*)
+        |(?P<op>&&|\|\||<<|>>|<=|>=|==|!=|[!~()+\-*/%<>&^|,])
+    )""", re.VERBOSE)
+
+
+class Macros:
+    """Macro environment of a target platform.
+
+    Names in defined have a value, names in undefined are known not to be
+    defined. Any other name is unknown, and conditions that depend on it
+    can't be resolved.
+    """
+
+    def __init__(self, defined=None, undefined=()):
+        self.defined = dict(defined or {})
+        self.undefined = set(undefined) - set(self.defined)
+        self.cache = {}
+
+    @classmethod
+    def from_host(cls):
+        """Return the macros of pyconfig.h and of the platform of the running interpreter."""
+        defined = {}
+        undefined = set()
+        for name, value in sysconfig.get_config_vars().items():
+            if isinstance(value, int) and re.fullmatch(r"[A-Z_][A-Z0-9_]*", name):
+                # pyconfig.h entries that are #undef are reported as 0
+                if value:
+                    defined[name] = value
+                else:
+                    undefined.add(name)
+        platforms = {
+            "win32": ["MS_WINDOWS", "_WIN32"],
+            "darwin": ["__APPLE__"],
+            "linux": ["__linux__"],
+        }
+        for platform, names in platforms.items():
+            if sys.platform.startswith(platform):
+                defined.update(dict.fromkeys(names, 1))
+            else:
+                undefined.update(names)
+        return cls(defined, undefined)
+
+    def evaluate(self, condition):
+        """Evaluate an #if condition.
+
+        Return its integer value or None if it depends on unknown macros or
+        on constructs that aren't supported (function-like macros, ?:).
+        """
+        try:
+            return self.cache[condition]
+        except KeyError:
+            pass
+        self.cache[condition] = None  # guards against self-referencing macros
+        try:
+            parser = _Parser(self, condition)
+            value = parser.parse_expression()
+            if parser.peek() is not None:
+                raise ValueError("Unexpected token", parser.peek())
+        except ValueError:
+            value = None
+        self.cache[condition] = value
+        return value
+
+    def value(self, name):
+        if name in self.defined:
+            value = self.defined[name]
+            if isinstance(value, int):
+                return value
+            return self.evaluate(str(value)) if str(value).strip() else None
+        if name in self.undefined:
+            return 0
+        return None
+
+    def is_defined(self, name):
+        if name in self.defined:
+            return 1
+        if name in self.undefined:
+            return 0
+        return None
+
+
+class _Parser:
+    def __init__(self, macros, condition):
+        self.macros = macros
+        self.tokens = []
+        pos = 0
+        condition = condition.strip()
+        while pos < len(condition):
+            match = TOKEN.match(condition, pos)
+            if not match:
+                raise ValueError("Invalid token", condition[pos:])
+            self.tokens.append((match.lastgroup, match.group(match.lastgroup)))
+            pos = match.end()
+        self.pos = 0
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos][1]
+        return None
+
+    def next(self):
+        if self.pos >= len(self.tokens):
+            raise ValueError("Unexpected end of condition")
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def expect(self, value):
+        if self.next()[1] != value:
+            raise ValueError("Expected", value)
+
+    def parse_expression(self, min_precedence=1):
+        left = self.parse_unary()
+        while True:
+            op = self.peek()
+            precedence = BINARY_OPERATORS.get(op)
+            if precedence is None or precedence < min_precedence:
+                return left
+            self.next()
+            right = self.parse_expression(precedence + 1)
+            left = self.binary(op, left, right)
+
+    @staticmethod
+    def binary(op, left, right):
+        if op == "&&":
+            if left == 0 or right == 0:
+                return 0
+            return None if left is None or right is None else 1
+        if op == "||":
+            if left not in (0, None) or right not in (0, None):
+                return 1
+            return None if left is None or right is None else 0
+        if left is None or right is None:
+            return None
+        if op in ("/", "%"):
+            if right == 0:
+                return None
+            # C division truncates toward zero
+            quotient = abs(left) // abs(right) * (1 if (left < 0) == (right < 0) else -1)
+            return quotient if op == "/" else left - quotient * right
+        return int({
+            "|": lambda: left | right,
+            "^": lambda: left ^ right,
+            "&": lambda: left & right,
+            "==": lambda: left == right,
+            "!=": lambda: left != right,
+            "<": lambda: left < right,
+            ">": lambda: left > right,
+            "<=": lambda: left <= right,
+            ">=": lambda: left >= right,
+            "<<": lambda: left << right,
+            ">>": lambda: left >> right,
+            "+": lambda: left + right,
+            "-": lambda: left - right,
+            "*": lambda: left * right,
+        }[op]())
+
+    def parse_unary(self):
+        kind, token = self.next()
+        if token in ("!", "-", "+", "~"):
+            value = self.parse_unary()
+            if value is None:
+                return None
+            return {"!": int(not value), "-": -value, "+": value, "~": ~value}[token]
+        if token == "(":
+            value = self.parse_expression()
+            self.expect(")")
+            return value
+        if kind == "number":
+            return int(token, 16) if token[:2] in ("0x", "0X") else int(token, 8 if token.startswith("0") else 10)
+        if kind == "name":
+            if token == "defined":
+                if self.peek() == "(":
+                    self.next()
+                    kind, name = self.next()
+                    self.expect(")")
+                else:
+                    kind, name = self.next()
+                if kind != "name":
+                    raise ValueError("Invalid defined() argument", name)
+                return self.macros.is_defined(name)
+            if self.peek() == "(":
+                # Function-like macro (e.g. __has_include), skip its arguments
+                self.skip_arguments()
+                return None
+            return self.macros.value(token)
+        raise ValueError("Unexpected token", token)
+
+    def skip_arguments(self):
+        depth = 0
+        while True:
+            token = self.next()[1]
+            if token == "(":
+                depth += 1
+            elif token == ")":
+                depth -= 1
+                if not depth:
+                    return
+
+
+class Monitor(_Monitor):
+    """cpp.Monitor that only runs the full state machine on lines that can change it.
+
+    Besides feeding lines one by one, a whole source can be scanned at once
+    with scan(), which builds a table of line intervals and their conditions.
+    """
+
+    # Lines that may be a directive, open or close a block comment or continue on the next line
+    interesting_line = re.compile(r"^.*(?:#|/\*|\*/|\\[ \t\r\f\v]*$).*$", re.MULTILINE)
+
+    def __init__(self, filename=None, *, verbose=False, macros=None):
+        super().__init__(filename, verbose=verbose)
+        self.macros = macros
+        self.starts = [0]
+        self.conditions = [""]
+
+    def writeline(self, line):
+        if self.continuation is None and "#" not in line and "/*" not in line and "*/" not in line:
+            if not line.rstrip().endswith("\\"):
+                self.line_number += 1
+                return
+        super().writeline(line)
+
+    def scan(self, text):
+        """Feed text and return the interval table as (first line, condition) pairs.
+
+        Only the lines matched by interesting_line (and lines following a
+        continuation) go through writeline, the rest are skipped at once.
+        """
+        first_line = self.line_number + 1
+        last_line = self.line_number + text.count("\n") + 1
+        lines = text.split("\n")
+        line_number = first_line
+        pos = 0
+        for match in self.interesting_line.finditer(text):
+            line_number += text.count("\n", pos, match.start())
+            pos = match.start()
+            if line_number <= self.line_number:
+                # Already fed as a continuation
+                continue
+            self.line_number = line_number - 1
+            self.writeline(match.group())
+            while self.continuation is not None and self.line_number < last_line:
+                self.writeline(lines[self.line_number - first_line + 1])
+            self.record()
+        self.line_number = last_line
+        return list(zip(self.starts, self.conditions))
+
+    def record(self):
+        condition = self.condition()
+        if condition == self.conditions[-1]:
+            return
+        if self.starts[-1] == self.line_number:
+            self.conditions[-1] = condition
+        else:
+            self.starts.append(self.line_number)
+            self.conditions.append(condition)
+
+    def condition_at(self, line_number):
+        """Return the #if condition in effect at line_number after a scan()."""
+        return self.conditions[bisect_right(self.starts, line_number) - 1]
+
+    def is_disabled(self, condition=None):
+        """Return True if the condition is statically false for the macro environment."""
+        if condition is None:
+            condition = self.condition()
+        if not condition or self.macros is None:
+            return False
+        return self.macros.evaluate(condition) == 0
+
+    def disabled_at(self, line_number):
+        return self.is_disabled(self.condition_at(line_number))
+
+
+def add_macro_arguments(parser):
+    parser.add_argument(
+        "-D", dest="define", metavar="NAME[=VALUE]", action="append", default=[],
+        help="define a macro of the target platform"
+    )
+    parser.add_argument(
+        "-U", dest="undefine", metavar="NAME", action="append", default=[],
+        help="mark a macro as undefined on the target platform"
+    )
+    parser.add_argument(
+        "--host-macros", action="store_true",
+        help="use the macros of the running interpreter's platform"
+    )
+
+
+def get_macros(args):
+    """Return the Macros given by the command line, or None if there are none."""
+    if not (args.define or args.undefine or args.host_macros):
+        return None
+    macros = Macros.from_host() if args.host_macros else Macros()
+    for define in args.define:
+        name, _, value = define.partition("=")
+        macros.defined[name] = value or 1
+        macros.undefined.discard(name)
+    for name in args.undefine:
+        macros.defined.pop(name, None)
+        macros.undefined.add(name)
+    return macros
@@ -1,32 +1,245 @@
 import os
+import re
 import sysconfig
 import requests
 import tempfile
 import subprocess
+import tarfile
 import hashlib
+import argparse
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "promisedio_buildtools")
+
+
+class LocalSource:
+    """CPython sources from a local checkout or a source tarball."""
+
+    def __init__(self, location):
+        self.location = location
+        self.tar = None
+        self.lock = threading.Lock()
+        if os.path.isdir(location):
+            self.prefix = location
+            with open(os.path.join(location, "Include", "patchlevel.h"), "rt") as f:
+                self.version = self.parse_version(f.read())
+        else:
+            self.tar = tarfile.open(location)
+            self.members = {}
+            for member in self.tar.getmembers():
+                if member.isfile():
+                    _, _, name = member.name.partition("/")
+                    self.members[name] = member
+            f = self.tar.extractfile(self.members["Include/patchlevel.h"])
+            self.version = self.parse_version(f.read().decode("utf-8"))
+
+    @staticmethod
+    def parse_version(patchlevel):
+        return re.search(r'#define\s+PY_VERSION\s+"([^"+]*)', patchlevel).group(1)
+
+    def get_content(self, path):
+        if self.tar is None:
+            filename = os.path.join(self.prefix, path)
+            if os.path.exists(filename):
+                with open(filename, "rb") as f:
+                    return f.read()
+            return None
+        member = self.members.get(path)
+        if member is None:
+            return None
+        with self.lock:
+            return self.tar.extractfile(member).read()
+
+
+class Downloader:
+    """Resolves CPython files from local sources, the cache or GitHub.
+
+    Downloaded files are stored in a content-addressed cache: blobs are
+    named by their sha256, and refs map a (version, path) to a blob.
+    """
+
+    def __init__(self, cache_dir=None, local_sources=()):
+        self.cache_dir = cache_dir
+        self.local_sources = [LocalSource(location) for location in local_sources]
+        self.session = None
+        self.lock = threading.Lock()
+
+    def ref_path(self, ver, path):
+        key = hashlib.sha1(f"{ver}/{path}".encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, "refs", key[:2], key)
+
+    def blob_path(self, digest):
+        return os.path.join(self.cache_dir, "blobs", digest[:2], digest)
+
+    def get_cached(self, ver, path):
+        try:
+            with open(self.ref_path(ver, path), "rt") as f:
+                digest = f.read().strip()
+            with open(self.blob_path(digest), "rb") as f:
+                content = f.read()
+        except OSError:
+            return None
+        if hashlib.sha256(content).hexdigest() != digest:
+            return None
+        return content
+
+    def put_cached(self, ver, path, content):
+        digest = hashlib.sha256(content).hexdigest()
+        write_file(self.blob_path(digest), content)
+        write_file(self.ref_path(ver, path), digest.encode("utf-8"))
+
+    def get_content(self, ver, path):
+        for source in self.local_sources:
+            if "v" + source.version == ver:
+                content = source.get_content(path)
+                if content is not None:
+                    print(f"Local {ver}: {path}")
+                    return content
+        if self.cache_dir:
+            content = self.get_cached(ver, path)
+            if content is not None:
+                print(f"Cached {ver}: {path}")
+                return content
+        print(f"Download {ver}: {path}")
+        with self.lock:
+            if self.session is None:
+                self.session = requests.Session()
+        url = f"https://raw.githubusercontent.com/python/cpython/{ver}/{path}"
+        response = self.session.get(url)
+        response.raise_for_status()
+        content = response.content
+        if self.cache_dir:
+            self.put_cached(ver, path, content)
+        return content
+
+
+def write_file(filename, content):
+    dirname = os.path.dirname(filename)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    # Like pyclinic.write_file: a sibling .new file replaces the target. It is
+    # created with the default permissions and gets the mode of an existing target.
+    tmp = f"{filename}.{os.getpid()}.{threading.get_ident()}.new"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(content)
+        try:
+            os.chmod(tmp, os.stat(filename).st_mode & 0o7777)
+        except FileNotFoundError:
+            pass
+        os.replace(tmp, filename)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def update_file(filename, content):
+    try:
+        with open(filename, "rb") as f:
+            if f.read() == content:
+                return False
+    except OSError:
+        pass
+    write_file(filename, content)
+    return True
+
+
+def file_hash(filename):
+    try:
+        with open(filename, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+downloader = Downloader()
 
 
 def get_content(ver, path):
-    print(f"Download {ver}: {path}")
-    url = f"https://raw.githubusercontent.com/python/cpython/{ver}/{path}"
-    return requests.get(url).content
+    return downloader.get_content(ver, path)
 
 
-def remove_comments(code):
-    new_code = []
+C_SPECIAL = re.compile(rb"[\"']|/[/*]")
+C_LITERAL = {
+    ord('"'): re.compile(rb'"(?:[^"\\]|\\.)*"'),
+    ord("'"): re.compile(rb"'(?:[^'\\]|\\.)*'"),
+}
+
+
+def iter_remove_comments(lines):
+    """Strip C comments from an iterable of lines and collapse blank runs.
+
+    String and char literals are kept intact, lines that only held comments
+    are dropped and the input is consumed lazily.
+    """
     comment_block = False
+    line_comment = False
     empty_line = False
-    for line in code.splitlines():
-        stripped_line = line.strip()
-        if stripped_line.startswith(b"//"):
+    for line in lines:
+        line = line.rstrip(b"\r\n")
+        if line_comment:
+            # Backslash continued // comment
+            line_comment = line.endswith(b"\\")
             continue
-        if stripped_line.startswith(b"/*"):
-            comment_block = True
-        if comment_block:
-            if stripped_line.endswith(b"*/"):
+        pieces = []
+        commented = comment_block
+        pos = 0
+        while pos < len(line):
+            if comment_block:
+                end = line.find(b"*/", pos)
+                if end < 0:
+                    break
                 comment_block = False
+                pos = end + 2
+                # A comment between tokens still separates them, a leading one
+                # is dropped together with the space after it
+                if any(piece.strip() for piece in pieces):
+                    pieces.append(b" ")
+                else:
+                    pos = len(line) - len(line[pos:].lstrip())
+                continue
+            match = C_SPECIAL.search(line, pos)
+            if match is None:
+                pieces.append(line[pos:])
+                break
+            start = match.start()
+            pieces.append(line[pos: start])
+            token = match.group()
+            if token == b"//":
+                commented = True
+                line_comment = line.endswith(b"\\")
+                break
+            if token == b"/*":
+                commented = True
+                comment_block = True
+                pos = start + 2
+                continue
+            literal = C_LITERAL[line[start]].match(line, start)
+            # An unterminated literal (e.g. an apostrophe in #error) runs to the end of line
+            pos = literal.end() if literal else len(line)
+            pieces.append(line[start: pos])
+        if commented:
+            line = b"".join(pieces).rstrip()
+            if not line.strip():
+                continue
+        if empty_line and not line.strip():
             continue
+        empty_line = not line.strip()
+        yield line
+
+
+def remove_comments(code):
+    return b"\n".join(iter_remove_comments(code.splitlines()))
+
+
+def collapse_blank_lines(code):
+    new_code = []
+    empty_line = False
+    for line in code.splitlines():
+        stripped_line = line.strip()
         if empty_line and not stripped_line:
             continue
         empty_line = not stripped_line
@@ -34,87 +247,338 @@ def remove_comments(code):
     return b"\n".join(new_code)
 
 
+def is_c_source(path):
+    return path.endswith(".h") or path.endswith(".c")
+
+
 def ensure_dict(d):
     if not isinstance(d, dict):
         return {}
     return d
 
 
-def get_source_code(version, path, target, c_names=None, exclude_c_names=None,
-                    wrap_guards=None, stub_template=None):
-    if wrap_guards is None:
-        wrap_guards = path.endswith(".h") or path.endswith(".c")
-    path = path.format(version=version)
-    target = target.format(version=version)
-    code = get_content("v" + version, path)
-    if c_names or exclude_c_names:
-        with tempfile.NamedTemporaryFile(suffix=".c") as f:
-            f.write(code)
-            options = [
-                f"-I{sysconfig.get_config_var('INCLUDEDIR')}",
-                f"-I{sysconfig.get_config_var('INCLUDEPY')}"
-            ]
-            if c_names:
-                options += [f"-D{d['ifdef']}=1" for d in c_names.values() if ensure_dict(d).get("ifdef")]
-            ret = subprocess.run(
-                ["clang", "-Xclang", "-ast-dump=json", *options, f.name],
-                capture_output=True
-            )
-            dat = json.loads(ret.stdout)
-        if c_names:
-            code_pieces = []
-            for node in dat["inner"]:
-                if node["kind"].endswith("Decl") and node.get("name") in c_names:
-                    ifdef = ensure_dict(c_names[node["name"]]).get("ifdef")
-                    only_source_hash = ensure_dict(c_names[node["name"]]).get("only_source_hash")
-                    start = node["range"]["begin"]["offset"]
-                    end = node["range"]["end"]["offset"]
-                    if node["kind"] != "TypedefDecl":
-                        end += 1
-                    piece = code[start: end]
-                    if node["kind"] == "TypedefDecl":
-                        piece += node["name"].encode("utf-8")
-                    if node["kind"] != "FunctionDecl":
-                        piece += b";"
-                    if ifdef:
-                        piece = b"#ifdef " + ifdef.encode("utf-8") + b"\n" + piece + b"\n#endif"
-                    if only_source_hash:
-                        piece_hash = hashlib.md5(piece).hexdigest()[:8].encode("utf-8")
-                        piece = b"\n".join(b"// %s" % line for line in piece.splitlines())
-                        piece = b"#define %s_hash 0x%s\n%s" % (node["name"].encode("utf-8"), piece_hash, piece)
-                    code_pieces.append(piece)
-            code = b"\n\n".join(code_pieces)
+# Bump when a change of the extraction code changes the generated targets
+LOCK_VERSION = 2
+
+# Bump when a change of the AST scan changes the cached declarations
+AST_CACHE_VERSION = 3
+
+
+def clang_include_dirs():
+    return [sysconfig.get_config_var("INCLUDEDIR"), sysconfig.get_config_var("INCLUDEPY")]
+
+
+def update_loc_file(loc, filename):
+    # clang only names the file of a location when it differs from the previously dumped one
+    if "spellingLoc" in loc or "expansionLoc" in loc:
+        for key in ("spellingLoc", "expansionLoc"):
+            filename = update_loc_file(loc.get(key, {}), filename)
+        return filename
+    return loc.get("file", filename)
+
+
+def loc_offset(loc):
+    return loc.get("expansionLoc", loc)["offset"]
+
+
+def iter_top_level_nodes(lines):
+    """Yield (node, filename) for the translation unit level nodes of a clang JSON AST dump.
+
+    The dump is read line by line as clang pretty-prints it (two spaces per
+    level). Only the keys of a top level node before its "inner" list are
+    decoded, nested nodes are skipped. filename is the file the node starts in.
+    """
+    filename = None
+    included_from = False
+    node = None
+    for line in lines:
+        stripped = line.strip()
+        if stripped.startswith(b'"file": '):
+            if included_from:
+                included_from = False
+            else:
+                filename = json.loads(stripped[8:].rstrip(b","))
+        elif stripped.startswith(b'"includedFrom": '):
+            included_from = True
+        if node is None:
+            if line.rstrip() == b"    {":
+                node = [b"{"]
+                node_filename = filename
+            continue
+        if line.rstrip() in (b"    }", b"    },", b'      "inner": ['):
+            node = json.loads(b"".join(node).rstrip().rstrip(b",") + b"}")
+            node_filename = update_loc_file(node.get("loc", {}), node_filename)
+            yield node, update_loc_file(node.get("range", {}).get("begin", {}), node_filename)
+            node = None
         else:
-            code = bytearray(code)
-            blocks = []
-            for node in dat["inner"]:
-                if node["kind"].endswith("Decl") and node.get("name") in exclude_c_names:
-                    start = node["range"]["begin"]["offset"]
-                    end = node["range"]["end"]["offset"]
-                    if node["kind"] == "FunctionDecl":
-                        end += 1
-                    blocks.append((start, end))
-            blocks.reverse()
-            for start, end in blocks:
-                code[start: end] = b"//"
-
-    code = remove_comments(code)
-    dirname = os.path.dirname(target)
-    if dirname:
-        os.makedirs(dirname, exist_ok=True)
+            node.append(line)
+
+
+def dump_decls(code, defines=()):
+    """Return the declarations of code and whether clang succeeded.
+
+    clang still dumps the AST after recoverable errors (e.g. an #error in a
+    header), its declarations are used then, but the caller shouldn't cache them.
+    """
+    decls = []
+    with tempfile.NamedTemporaryFile(suffix=".c") as f, tempfile.TemporaryFile() as stderr:
+        f.write(code)
+        f.flush()
+        args = [
+            "clang", "-fsyntax-only", "-Xclang", "-ast-dump=json",
+            *(f"-I{include_dir}" for include_dir in clang_include_dirs()),
+            *(f"-D{define}=1" for define in defines),
+            f.name
+        ]
+        # The whole AST is dumped once and scanned while clang writes it
+        with subprocess.Popen(args, stdout=subprocess.PIPE, stderr=stderr) as proc:
+            for node, filename in iter_top_level_nodes(proc.stdout):
+                name = node.get("name")
+                if name and filename == f.name and not node.get("isImplicit"):
+                    node_range = node["range"]
+                    decls.append((name, node["kind"], loc_offset(node_range["begin"]), loc_offset(node_range["end"])))
+        if proc.returncode:
+            stderr.seek(0)
+            errors = stderr.read().decode("utf-8", "replace").strip().splitlines()
+            print(f"Warning: clang exited with {proc.returncode}, declarations may be incomplete")
+            for line in errors[:5]:
+                print(f"  {line}")
+    decls.sort(key=lambda decl: decl[2])
+    return decls, not proc.returncode
+
+
+def get_decls(code, defines=(), cache_dir=None):
+    """Return (name, kind, start, end) of all named top level declarations of code.
+
+    Results are cached by the source hash, the defines and the include
+    directories, so any set of names of the file is served by one parse.
+    Results of a parse that clang reported errors for are not cached.
+    """
+    key = json.dumps([
+        AST_CACHE_VERSION, hashlib.sha256(code).hexdigest(), sorted(defines), clang_include_dirs()
+    ]).encode("utf-8")
+    key = hashlib.sha256(key).hexdigest()
+    filename = cache_dir and os.path.join(cache_dir, "decls", key[:2], key + ".json")
+    if filename:
+        try:
+            with open(filename, "rt") as f:
+                return [tuple(decl) for decl in json.load(f)]
+        except (OSError, ValueError):
+            pass
+    decls, complete = dump_decls(code, defines)
+    if filename and complete:
+        write_file(filename, json.dumps(decls).encode("utf-8"))
+    return decls
+
+
+class DeclIndex:
+    """Top level declarations of one source file, by name."""
+
+    def __init__(self, decls):
+        self.decls = decls
+        self.names = {}
+        for decl in decls:
+            self.names.setdefault(decl[0], []).append(decl)
+
+    def select(self, names):
+        return sorted(
+            (decl for name in names for decl in self.names.get(name, ())),
+            key=lambda decl: decl[2]
+        )
+
+
+def get_defines(c_names):
+    if not c_names:
+        return ()
+    return tuple(sorted({d["ifdef"] for d in c_names.values() if ensure_dict(d).get("ifdef")}))
+
+
+def extract_code(code, c_names=None, exclude_c_names=None, cache_dir=None, index=None, c_source=True):
+    if index is None and (c_names or exclude_c_names):
+        index = DeclIndex(get_decls(code, get_defines(c_names), cache_dir))
+    if c_names:
+        code_pieces = []
+        for name, kind, start, end in index.select(c_names):
+            ifdef = ensure_dict(c_names[name]).get("ifdef")
+            only_source_hash = ensure_dict(c_names[name]).get("only_source_hash")
+            if kind != "TypedefDecl":
+                end += 1
+            piece = code[start: end]
+            if kind == "TypedefDecl":
+                piece += name.encode("utf-8")
+            if kind != "FunctionDecl":
+                piece += b";"
+            if ifdef:
+                piece = b"#ifdef " + ifdef.encode("utf-8") + b"\n" + piece + b"\n#endif"
+            if only_source_hash:
+                piece_hash = hashlib.md5(piece).hexdigest()[:8].encode("utf-8")
+                piece = b"\n".join(b"// %s" % line for line in piece.splitlines())
+                piece = b"#define %s_hash 0x%s\n%s" % (name.encode("utf-8"), piece_hash, piece)
+            code_pieces.append(piece)
+        code = b"\n\n".join(code_pieces)
+    elif exclude_c_names:
+        code = bytearray(code)
+        blocks = []
+        for name, kind, start, end in index.select(exclude_c_names):
+            if kind == "FunctionDecl":
+                end += 1
+            blocks.append((start, end))
+        blocks.reverse()
+        for start, end in blocks:
+            code[start: end] = b"//"
+    if c_source:
+        return remove_comments(code)
+    # C comment syntax means something else in other languages (e.g. // in Python)
+    return collapse_blank_lines(code)
+
+
+def extract_codes(code, jobs, cache_dir=None):
+    """Extract all jobs of one upstream file, parsing it once per set of defines."""
+    indexes = {}
+    for job in jobs:
+        defines = get_defines(job["c_names"])
+        if (job["c_names"] or job["exclude_c_names"]) and defines not in indexes:
+            indexes[defines] = DeclIndex(get_decls(code, defines, cache_dir))
+    return [
+        extract_code(
+            code, job["c_names"], job["exclude_c_names"],
+            index=indexes.get(get_defines(job["c_names"])), c_source=is_c_source(job["path"])
+        )
+        for job in jobs
+    ]
+
+
+def render_target(target, code, wrap_guards):
     if wrap_guards:
         filename = os.path.split(target)[1]
         guard = ("HEADER_" + filename.replace(".", "_").upper()).encode("utf-8")
         code = b"#ifndef %s\n#define %s\n\n%s\n\n#endif" % (guard, guard, code)
-    with open(target, "wt") as f:
-        f.write(code.decode("utf-8"))
+    return code
+
+
+def resolve_item(version, path, target, c_names=None, exclude_c_names=None,
+                 wrap_guards=None, stub_template=None):
+    if wrap_guards is None:
+        wrap_guards = is_c_source(path)
+    return {
+        "ver": "v" + version,
+        "path": path.format(version=version),
+        "target": target.format(version=version),
+        "c_names": c_names,
+        "exclude_c_names": exclude_c_names,
+        "wrap_guards": wrap_guards,
+    }
+
+
+def options_hash(job):
+    options = json.dumps([LOCK_VERSION, job], sort_keys=True).encode("utf-8")
+    return hashlib.sha256(options).hexdigest()
+
+
+def read_lock(filename):
+    try:
+        with open(filename, "rt") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def is_locked(lock, job):
+    entry = lock.get(job["target"])
+    return (
+        entry is not None and
+        entry["options"] == options_hash(job) and
+        entry["sha256"] == file_hash(job["target"])
+    )
+
+
+def get_source_code(version, path, target, c_names=None, exclude_c_names=None,
+                    wrap_guards=None, stub_template=None):
+    process_jobs([resolve_item(version, path, target, c_names, exclude_c_names, wrap_guards)])
+
+
+def process_jobs(jobs, workers=1, lock=None):
+    """Generate targets of jobs and return the lock entries of the written ones.
+
+    Jobs whose target still matches its entry in the lock are skipped.
+    """
+    if lock:
+        jobs = [job for job in jobs if not is_locked(lock, job)]
+    # Jobs reading the same upstream file share one download and one parse.
+    # Downloads are I/O bound and run on threads, clang runs are CPU bound
+    # and run on processes. Targets are written in job order.
+    files = {}
+    for job in jobs:
+        files.setdefault((job["ver"], job["path"]), []).append(job)
+    groups = list(files.values())
+    cache_dirs = [downloader.cache_dir] * len(groups)
+    if workers > 1:
+        with ThreadPoolExecutor(workers) as pool:
+            contents = list(pool.map(lambda key: get_content(*key), files))
+        with ProcessPoolExecutor(workers) as pool:
+            results = list(pool.map(extract_codes, contents, groups, cache_dirs))
+    else:
+        contents = [get_content(*key) for key in files]
+        results = list(map(extract_codes, contents, groups, cache_dirs))
+    codes = {}
+    for group, content, group_codes in zip(groups, contents, results):
+        source_hash = hashlib.sha256(content).hexdigest()
+        for job, code in zip(group, group_codes):
+            codes[id(job)] = source_hash, code
+    entries = {}
+    for job in jobs:
+        source_hash, code = codes[id(job)]
+        code = render_target(job["target"], code, job["wrap_guards"])
+        if update_file(job["target"], code):
+            print(f"Write {job['target']}")
+        entries[job["target"]] = {
+            "source": f"{job['ver']}/{job['path']}",
+            "source_sha256": source_hash,
+            "options": options_hash(job),
+            "sha256": hashlib.sha256(code).hexdigest(),
+        }
+    return entries
 
 
-def main():
+def main(params=None):
+    global downloader
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--cpython-src", metavar="PATH", action="append", default=[],
+        help="CPython checkout or source tarball used instead of downloading (may be repeated)"
+    )
+    parser.add_argument(
+        "--cache-dir", metavar="PATH",
+        default=os.environ.get("PROMISEDIO_CACHE_DIR", DEFAULT_CACHE_DIR),
+        help="directory of the download cache"
+    )
+    parser.add_argument("--no-cache", action="store_true", help="do not use the download cache")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="number of parallel downloads and clang processes"
+    )
+    parser.add_argument(
+        "--lock", metavar="PATH", default="sources.lock",
+        help="lockfile with hashes of the generated targets"
+    )
+    parser.add_argument("--force", action="store_true", help="regenerate all targets ignoring the lockfile")
+    args = parser.parse_args(params)
+    downloader = Downloader(None if args.no_cache else args.cache_dir, args.cpython_src)
     items = json.loads(open("sources.json", "rt").read())
-    for item in items:
-        for version in sorted(item.pop("version")):
-            get_source_code(version, **item)
+    jobs = [
+        resolve_item(version, **item)
+        for item in items
+        for version in sorted(item.pop("version"))
+    ]
+    lock = {} if args.force else read_lock(args.lock)
+    entries = process_jobs(jobs, args.jobs, lock)
+    if not entries:
+        print("Up to date")
+        return
+    lock.update(entries)
+    targets = {job["target"] for job in jobs}
+    lock = {target: entry for target, entry in sorted(lock.items()) if target in targets}
+    update_file(args.lock, (json.dumps(lock, indent=2) + "\n").encode("utf-8"))
 
 
 if __name__ == "__main__":
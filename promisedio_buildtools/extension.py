@@ -1,12 +1,203 @@
+import os
+import glob
+import shutil
+import functools
+import subprocess
 import pkg_resources
+from distutils import log
+from distutils.ccompiler import gen_preprocess_options
+from distutils.dep_util import newer_group
 from setuptools.extension import Extension as _Extension
+from setuptools.command.build_ext import build_ext as _build_ext
+
+
+PRECOMPILED_HEADERS = ["promisedio.h"]
+
+# clinic_converters.h needs the libuv types
+UV_PRECOMPILED_HEADERS = ["promisedio.h", "promisedio_uv.h", "clinic_converters.h"]
 
 
 class Extension(_Extension):
-    def __init__(self, name, sources, *, capsules=None, **kwargs):
+    """Promisedio extension.
+
+    precompiled_header=True precompiles promisedio.h once per build and
+    includes it in every source, a list of headers (e.g. UV_PRECOMPILED_HEADERS
+    for libuv based extensions) can be given instead. It requires building
+    with promisedio_buildtools.extension.build_ext.
+
+    unity=True compiles all C sources as one translation unit, which lets
+    the compiler inline across files. Static names must then be unique
+    across the sources.
+    """
+
+    def __init__(self, name, sources, *, capsules=None, precompiled_header=False, unity=False, **kwargs):
         include_dirs = kwargs.pop("include_dirs", None) or []
         include_dirs.append(pkg_resources.resource_filename("promisedio_buildtools", "include"))
         if capsules:
             for capsule in capsules:
                 include_dirs.append(pkg_resources.resource_filename(capsule, "capsule"))
         super().__init__(name, sources, include_dirs=include_dirs, **kwargs)
+        if precompiled_header is True:
+            precompiled_header = PRECOMPILED_HEADERS
+        self.precompiled_header = list(precompiled_header or [])
+        self.unity = unity
+
+
+@functools.lru_cache()
+def is_clang(compiler):
+    try:
+        output = subprocess.run([compiler, "--version"], capture_output=True, text=True).stdout
+    except OSError:
+        return False
+    return "clang" in output
+
+
+class build_ext(_build_ext):
+    """build_ext with precompiled headers, unity builds and profile-guided optimization.
+
+    With --pgo-train (or PROMISEDIO_PGO_TRAIN) the extensions are built with
+    instrumentation, the training command is run with them importable, and
+    the extensions are rebuilt using the collected profile.
+    """
+
+    user_options = _build_ext.user_options + [
+        ("pgo-train=", None, "shell command running the PGO training workload"),
+    ]
+
+    def initialize_options(self):
+        super().initialize_options()
+        self.pch_cache = {}
+        self.pgo_train = None
+        self.pgo_stage = None
+
+    def finalize_options(self):
+        super().finalize_options()
+        if self.pgo_train is None:
+            self.pgo_train = os.environ.get("PROMISEDIO_PGO_TRAIN")
+
+    def run(self):
+        if not self.pgo_train:
+            super().run()
+            return
+        profile_dir = os.path.abspath(os.path.join(self.build_temp, "pgo"))
+        shutil.rmtree(profile_dir, ignore_errors=True)
+        os.makedirs(profile_dir)
+        self.force = True
+        # run() replaces the compiler name with the compiler object
+        compiler = self.compiler
+        log.info("PGO: building instrumented extensions")
+        self.pgo_stage = ("generate", profile_dir)
+        super().run()
+        if self.compiler.compiler_type != "unix":
+            log.warn("PGO is not supported by %s compiler", self.compiler.compiler_type)
+            return
+        log.info("PGO: running %s", self.pgo_train)
+        env = dict(os.environ)
+        if not self.inplace:
+            env["PYTHONPATH"] = os.pathsep.join(filter(None, [os.path.abspath(self.build_lib), env.get("PYTHONPATH")]))
+        subprocess.run(self.pgo_train, shell=True, check=True, env=env)
+        if is_clang(self.compiler.compiler_so[0]):
+            profiles = glob.glob(os.path.join(profile_dir, "*.profraw"))
+            self.spawn(["llvm-profdata", "merge", f"-output={os.path.join(profile_dir, 'default.profdata')}", *profiles])
+        log.info("PGO: building optimized extensions")
+        self.pgo_stage = ("use", profile_dir)
+        self.compiler = compiler
+        super().run()
+
+    def get_pgo_flags(self):
+        """Return the compile and link flags of the current PGO stage."""
+        if self.pgo_stage is None or self.compiler.compiler_type != "unix":
+            return [], []
+        stage, profile_dir = self.pgo_stage
+        if stage == "generate":
+            return [f"-fprofile-generate={profile_dir}"], [f"-fprofile-generate={profile_dir}"]
+        if is_clang(self.compiler.compiler_so[0]):
+            return [f"-fprofile-use={os.path.join(profile_dir, 'default.profdata')}"], []
+        return [f"-fprofile-use={profile_dir}", "-fprofile-correction", "-Wno-missing-profile"], []
+
+    def build_extension(self, ext):
+        sources = ext.sources
+        depends = ext.depends
+        extra_compile_args = ext.extra_compile_args
+        extra_link_args = ext.extra_link_args
+        try:
+            if getattr(ext, "unity", False):
+                ext.sources = self.build_unity_source(ext)
+                ext.depends = list(depends or []) + list(sources)
+            compile_flags, link_flags = self.get_pgo_flags()
+            ext.extra_compile_args = list(extra_compile_args or []) + compile_flags
+            ext.extra_link_args = list(extra_link_args or []) + link_flags
+            if getattr(ext, "precompiled_header", None) and self.needs_build(ext):
+                ext.extra_compile_args = self.build_pch(ext) + ext.extra_compile_args
+            super().build_extension(ext)
+        finally:
+            ext.sources = sources
+            ext.depends = depends
+            ext.extra_compile_args = extra_compile_args
+            ext.extra_link_args = extra_link_args
+
+    def needs_build(self, ext):
+        ext_path = self.get_ext_fullpath(ext.name)
+        return self.force or newer_group(list(ext.sources) + list(ext.depends or []), ext_path, "newer")
+
+    def build_unity_source(self, ext):
+        """Write a source that includes all C sources of ext and return the new source list."""
+        c_sources = [source for source in ext.sources if os.path.splitext(source)[1] == ".c"]
+        other_sources = [source for source in ext.sources if source not in c_sources]
+        if len(c_sources) < 2:
+            return ext.sources
+        unity_dir = os.path.join(self.build_temp, "unity")
+        os.makedirs(unity_dir, exist_ok=True)
+        filename = os.path.join(unity_dir, ext.name.replace(".", "_") + ".c")
+        content = "".join(
+            f'#include "{os.path.abspath(source)}"\n'
+            for source in c_sources
+        )
+        # Keep the mtime of an unchanged unity source so it isn't rebuilt needlessly
+        try:
+            with open(filename, "rt") as f:
+                changed = f.read() != content
+        except OSError:
+            changed = True
+        if changed:
+            with open(filename, "wt") as f:
+                f.write(content)
+        return [filename] + other_sources
+
+    def build_pch(self, ext):
+        """Precompile the headers of ext and return the flags that include them."""
+        if self.compiler.compiler_type != "unix":
+            log.warn("precompiled headers are not supported by %s compiler", self.compiler.compiler_type)
+            return []
+        compiler = self.compiler.compiler_so
+        include_dirs = list(ext.include_dirs or []) + list(self.compiler.include_dirs or [])
+        # Same order as CCompiler.compile: build_ext --define/--undef come last
+        macros = [
+            *(ext.define_macros or []),
+            *((name,) for name in ext.undef_macros or []),
+            *(self.compiler.macros or [])
+        ]
+        args = [
+            *gen_preprocess_options(macros, include_dirs),
+            *(ext.extra_compile_args or [])
+        ]
+        # Extensions built with the same flags share one precompiled header
+        key = (tuple(compiler), tuple(args), tuple(ext.precompiled_header))
+        if key in self.pch_cache:
+            return self.pch_cache[key]
+        pch_dir = os.path.join(self.build_temp, "pch", str(len(self.pch_cache)))
+        os.makedirs(pch_dir, exist_ok=True)
+        header = os.path.join(pch_dir, "promisedio_pch.h")
+        with open(header, "wt") as f:
+            f.writelines(f'#include "{name}"\n' for name in ext.precompiled_header)
+        if is_clang(compiler[0]):
+            pch = header + ".pch"
+            flags = ["-include-pch", pch]
+        else:
+            # GCC picks up header.gch when the header is included
+            pch = header + ".gch"
+            flags = ["-include", header, "-Winvalid-pch"]
+        log.info("precompiling %s", ", ".join(ext.precompiled_header))
+        self.compiler.spawn([*compiler, *args, "-x", "c-header", header, "-o", pch])
+        self.pch_cache[key] = flags
+        return flags
@@ -23,13 +23,49 @@ if (cond) {                                                                 \
 #define LOGC(...)
 #endif
 
-#ifdef BUILD_DEBUG_MEM
-#define MEMLOG(action, ptr, type)                                           \
+#if defined(BUILD_DEBUG_MEM) && defined(BUILD_DEBUG_MEM_TRACE)
+#include "_promisedio/memtrace.h"
+#define MEMLOG_SIZE_AT(action, ptr, type, size, file, line, func)          \
+    Memtrace_Log(action, ptr, type, size, file, line, func)
+#define MEMLOG_AT(action, ptr, type, file, line, func)                      \
+    MEMLOG_SIZE_AT(action, ptr, type, 0, file, line, func)
+#elif defined(BUILD_DEBUG_MEM)
+#define MEMLOG_AT(action, ptr, type, file, line, func)                      \
     PySys_FormatStderr("#%s(%p, %s)", action, ptr, type),                   \
-    PySys_FormatStderr(" -- %s:%d, %s", __FILENAME__, __LINE__, __func__),  \
+    PySys_FormatStderr(" -- %s:%d, %s", __BASENAME__(file), line, func),    \
+    PySys_WriteStderr("\n")
+#define MEMLOG_SIZE_AT(action, ptr, type, size, file, line, func)          \
+    PySys_FormatStderr("#%s(%p, %s, %zu)", action, ptr, type, (size_t) (size)), \
+    PySys_FormatStderr(" -- %s:%d, %s", __BASENAME__(file), line, func),    \
     PySys_WriteStderr("\n")
 #else
-#define MEMLOG(...)
+#define MEMLOG_AT(...)
+#define MEMLOG_SIZE_AT(...)
+#endif
+
+#define MEMLOG(action, ptr, type)                                           \
+    MEMLOG_AT(action, ptr, type, __FILE__, __LINE__, __func__)
+#define MEMLOG_SIZE(action, ptr, type, size)                                \
+    MEMLOG_SIZE_AT(action, ptr, type, size, __FILE__, __LINE__, __func__)
+
+// Allocation helpers log the site of their caller rather than their own:
+// they take it with MEMLOG_SITE_PARAMS, their macros pass it with MEMLOG_SITE,
+// helpers calling other helpers forward it with MEMLOG_SITE_FORWARD, and
+// MEMLOG_CALLER/MEMLOG_CALLER_SIZE log at it.
+#ifdef BUILD_DEBUG_MEM
+#define MEMLOG_SITE_PARAMS , const char *_memlog_file, int _memlog_line, const char *_memlog_func
+#define MEMLOG_SITE , __FILE__, __LINE__, __func__
+#define MEMLOG_SITE_FORWARD , _memlog_file, _memlog_line, _memlog_func
+#define MEMLOG_CALLER(action, ptr, type)                                    \
+    MEMLOG_AT(action, ptr, type, _memlog_file, _memlog_line, _memlog_func)
+#define MEMLOG_CALLER_SIZE(action, ptr, type, size)                         \
+    MEMLOG_SIZE_AT(action, ptr, type, size, _memlog_file, _memlog_line, _memlog_func)
+#else
+#define MEMLOG_SITE_PARAMS
+#define MEMLOG_SITE
+#define MEMLOG_SITE_FORWARD
+#define MEMLOG_CALLER(...)
+#define MEMLOG_CALLER_SIZE(...)
 #endif
 
 #define ACQUIRE_GIL \
@@ -38,7 +74,8 @@ if (cond) {                                                                 \
     PyGILState_Release(_gstate); }
 
 #ifdef MS_WINDOWS
-#define __FILENAME__ (strrchr(__FILE__, '\\') ? strrchr(__FILE__, '\\') + 1 : __FILE__)
+#define __BASENAME__(path) (strrchr(path, '\\') ? strrchr(path, '\\') + 1 : (path))
+#define __FILENAME__ __BASENAME__(__FILE__)
 /* Windows uses long long for offsets */
 typedef long long Py_off_t;
 #define PyLong_AsOff_t     PyLong_AsLongLong
@@ -50,7 +87,8 @@ typedef long long Py_off_t;
 #define PyLong_FromUint64_t PyLong_FromUnsignedLongLong
 #else
 
-#define __FILENAME__ (strrchr(__FILE__, '/') ? strrchr(__FILE__, '/') + 1 : __FILE__)
+#define __BASENAME__(path) (strrchr(path, '/') ? strrchr(path, '/') + 1 : (path))
+#define __FILENAME__ __BASENAME__(__FILE__)
 /* Other platforms use off_t */
 typedef off_t Py_off_t;
 #if (SIZEOF_OFF_T == SIZEOF_SIZE_T)
@@ -7,50 +7,62 @@
 
 #ifdef BUILD_DEBUG_MEM
 Py_LOCAL_INLINE(void *)
-Py_Malloc(size_t n)
+Py_Malloc(size_t n MEMLOG_SITE_PARAMS)
 {
     void *ptr = PyMem_Malloc(n);
-    MEMLOG("Malloc", ptr, "RAW");
+    MEMLOG_CALLER_SIZE("Malloc", ptr, "RAW", n);
     return ptr;
 }
 
+#define Py_Malloc(n) Py_Malloc(n MEMLOG_SITE)
+
 Py_LOCAL_INLINE(void)
-Py_Free(void *op)
+Py_Free(void *op MEMLOG_SITE_PARAMS)
 {
-    MEMLOG("Free", op, "RAW");
+    MEMLOG_CALLER("Free", op, "RAW");
     PyMem_Free(op);
 }
 
+#define Py_Free(op) Py_Free(op MEMLOG_SITE)
+
 Py_LOCAL_INLINE(PyObject *)
-Py_New(PyTypeObject *tp)
+Py_New(PyTypeObject *tp MEMLOG_SITE_PARAMS)
 {
     PyObject *ptr = _PyObject_New(tp);
-    MEMLOG("New", ptr, Py_TYPE(ptr)->tp_name);
+    MEMLOG_CALLER_SIZE("New", ptr, Py_TYPE(ptr)->tp_name, _PyObject_SIZE(tp));
     return ptr;
 }
 
+#define Py_New(tp) Py_New(tp MEMLOG_SITE)
+
 Py_LOCAL_INLINE(PyObject *)
-Py_GC_New(PyTypeObject *tp)
+Py_GC_New(PyTypeObject *tp MEMLOG_SITE_PARAMS)
 {
     PyObject *ptr = _PyObject_GC_New(tp);
-    MEMLOG("New", ptr, Py_TYPE(ptr)->tp_name);
+    MEMLOG_CALLER_SIZE("New", ptr, Py_TYPE(ptr)->tp_name, _PyObject_SIZE(tp));
     return ptr;
 }
 
+#define Py_GC_New(tp) Py_GC_New(tp MEMLOG_SITE)
+
 Py_LOCAL_INLINE(void)
-Py_Delete(void *op)
+Py_Delete(void *op MEMLOG_SITE_PARAMS)
 {
-    MEMLOG("Delete", op, Py_TYPE(op)->tp_name);
+    MEMLOG_CALLER("Delete", op, Py_TYPE(op)->tp_name);
     PyMem_Free(op);
 }
 
+#define Py_Delete(op) Py_Delete(op MEMLOG_SITE)
+
 Py_LOCAL_INLINE(void)
-Py_GC_Delete(void *op)
+Py_GC_Delete(void *op MEMLOG_SITE_PARAMS)
 {
-    MEMLOG("Delete", op, Py_TYPE(op)->tp_name);
+    MEMLOG_CALLER("Delete", op, Py_TYPE(op)->tp_name);
     PyObject_GC_Del(op);
 }
 
+#define Py_GC_Delete(op) Py_GC_Delete(op MEMLOG_SITE)
+
 #define PyTrack_DECREF(op)                                  \
 do {                                                        \
     PyObject *_tmp = _PyObject_CAST(op);                    \
@@ -125,7 +137,8 @@ do {                                                        \
 #define PyTrack_NEW(op)                                     \
 do {                                                        \
     PyObject *_tmp = _PyObject_CAST(op);                    \
-    MEMLOG("New", _tmp, Py_TYPE(_tmp)->tp_name);            \
+    MEMLOG_SIZE("New", _tmp, Py_TYPE(_tmp)->tp_name,        \
+                _PyObject_SIZE(Py_TYPE(_tmp)));             \
 } while (0)
 
 #define PyTrack_DELETE(op)                                  \
@@ -258,22 +271,22 @@ freelist__push(freelist_raw_info *fl, void *ptr)
 }
 
 Py_LOCAL_INLINE(void *)
-Freelist_Malloc(freelist_raw_info *fl)
+Freelist_Malloc(freelist_raw_info *fl MEMLOG_SITE_PARAMS)
 {
     void *ptr = freelist__pop(fl);
     if (!ptr) {
         ptr = PyMem_Malloc(fl->obj_size);
     }
-    MEMLOG("Malloc", ptr, "RAW");
+    MEMLOG_CALLER_SIZE("Malloc", ptr, "RAW", fl->obj_size);
     return ptr;
 }
 
-#define Freelist_Malloc(name) Freelist_Malloc(&_ctx->name##__raw_freelist)
+#define Freelist_Malloc(name) Freelist_Malloc(&_ctx->name##__raw_freelist MEMLOG_SITE)
 
 Py_LOCAL_INLINE(void)
-Freelist_Free(freelist_raw_info *fl, void *ptr)
+Freelist_Free(freelist_raw_info *fl, void *ptr MEMLOG_SITE_PARAMS)
 {
-    MEMLOG("Free", ptr, "RAW");
+    MEMLOG_CALLER("Free", ptr, "RAW");
     if (fl->size >= fl->limit) {
         PyMem_Free(ptr);
     } else {
@@ -281,10 +294,10 @@ Freelist_Free(freelist_raw_info *fl, void *ptr)
     }
 }
 
-#define Freelist_Free(name, ptr) Freelist_Free(&_ctx->name##__raw_freelist, ptr)
+#define Freelist_Free(name, ptr) Freelist_Free(&_ctx->name##__raw_freelist, ptr MEMLOG_SITE)
 
 Py_LOCAL_INLINE(PyObject *)
-Freelist_New(freelist_info *fl, PyTypeObject *tp)
+Freelist_New(freelist_info *fl, PyTypeObject *tp MEMLOG_SITE_PARAMS)
 {
     void *ptr = freelist__pop((freelist_raw_info *) fl);
     if (ptr) {
@@ -292,16 +305,16 @@ Freelist_New(freelist_info *fl, PyTypeObject *tp)
     } else {
         ptr = _PyObject_New(tp);
     }
-    MEMLOG("New", ptr, Py_TYPE(ptr)->tp_name);
+    MEMLOG_CALLER_SIZE("New", ptr, Py_TYPE(ptr)->tp_name, _PyObject_SIZE(tp));
     return (PyObject *) ptr;
 }
 
-#define Freelist_New(name) Freelist_New(&_ctx->name##__freelist)
+#define Freelist_New(name) Freelist_New(&_ctx->name##__freelist, _ctx->name MEMLOG_SITE)
 
 Py_LOCAL_INLINE(void)
-Freelist_Delete(freelist_info *fl, PyObject *obj)
+Freelist_Delete(freelist_info *fl, PyObject *obj MEMLOG_SITE_PARAMS)
 {
-    MEMLOG("Delete", obj, Py_TYPE(obj)->tp_name);
+    MEMLOG_CALLER("Delete", obj, Py_TYPE(obj)->tp_name);
     if (fl->size >= fl->limit) {
         PyMem_Free(obj);
     } else {
@@ -309,10 +322,10 @@ Freelist_Delete(freelist_info *fl, PyObject *obj)
     }
 }
 
-#define Freelist_Delete(name, ob) Freelist_Delete(&_ctx->name##__freelist, _PyObject_CAST(ob))
+#define Freelist_Delete(name, ob) Freelist_Delete(&_ctx->name##__freelist, _PyObject_CAST(ob) MEMLOG_SITE)
 
 Py_LOCAL_INLINE(PyObject *)
-Freelist_GC_New(freelist_gc_info *fl, PyTypeObject *tp)
+Freelist_GC_New(freelist_gc_info *fl, PyTypeObject *tp MEMLOG_SITE_PARAMS)
 {
     void *ptr = freelist__pop((freelist_raw_info *) fl);
     if (ptr) {
@@ -320,16 +333,16 @@ Freelist_GC_New(freelist_gc_info *fl, PyTypeObject *tp)
     } else {
         ptr = _PyObject_GC_New(tp);
     }
-    MEMLOG("New", ptr, Py_TYPE(ptr)->tp_name);
+    MEMLOG_CALLER_SIZE("New", ptr, Py_TYPE(ptr)->tp_name, _PyObject_SIZE(tp));
     return (PyObject *) ptr;
 }
 
-#define Freelist_GC_New(name) Freelist_GC_New(&_ctx->name##__gc_freelist, _ctx->name)
+#define Freelist_GC_New(name) Freelist_GC_New(&_ctx->name##__gc_freelist, _ctx->name MEMLOG_SITE)
 
 Py_LOCAL_INLINE(void)
-Freelist_GC_Delete(freelist_gc_info *fl, PyObject *obj)
+Freelist_GC_Delete(freelist_gc_info *fl, PyObject *obj MEMLOG_SITE_PARAMS)
 {
-    MEMLOG("Delete", obj, Py_TYPE(obj)->tp_name);
+    MEMLOG_CALLER("Delete", obj, Py_TYPE(obj)->tp_name);
     if (fl->size >= fl->limit) {
         PyObject_GC_Del(obj);
     } else {
@@ -337,7 +350,7 @@ Freelist_GC_Delete(freelist_gc_info *fl, PyObject *obj)
     }
 }
 
-#define Freelist_GC_Delete(name, ob) Freelist_GC_Delete(&_ctx->name##__gc_freelist, _PyObject_CAST(ob))
+#define Freelist_GC_Delete(name, ob) Freelist_GC_Delete(&_ctx->name##__gc_freelist, _PyObject_CAST(ob) MEMLOG_SITE)
 
 #define Freelist_GC_Limit(name, value) (&(_ctx->name##__gc_freelist))->limit = (value)
 #define Freelist_Limit(name, value) (&(_ctx->name##__freelist))->limit = (value)
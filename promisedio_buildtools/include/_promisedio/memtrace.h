@@ -0,0 +1,538 @@
+// Copyright (c) 2021-2022 Andrey Churin <aachurin@gmail.com> Promisedio
+
+#ifndef PROMISEDIO_MEMTRACE_H
+#define PROMISEDIO_MEMTRACE_H
+
+// Binary MEMLOG backend (BUILD_DEBUG_MEM + BUILD_DEBUG_MEM_TRACE).
+//
+// Events are written as fixed-size records to <prefix>.<pid>.bin, where
+// prefix is taken from PROMISEDIO_MEMTRACE (default "memtrace").
+// Action names, type names and call sites are interned: the first time a
+// string is seen, a string record (action 0) defines its id, and all
+// further records refer to it by id. For event records, the extra field
+// holds the allocation size (0 if unknown). The file is decoded by
+// `memcheck --trace`.
+//
+// If PROMISEDIO_MEMTRACE_SAMPLE is set to N bytes, allocations are sampled
+// by bytes (on average one sample every N allocated bytes, as in tcmalloc's
+// heap profiler). Only sampled allocations and later events for the same
+// pointers are written; memcheck scales the estimates back.
+//
+// On POSIX the buffer is a window mapped onto the file, so records reach the
+// file even if the process leaves through os._exit. The unused rest of the
+// last window stays zeroed and is trimmed on a regular exit; a zero record
+// marks the end of data for the reader. A forked child drops the inherited
+// mapping and starts its own <prefix>.<pid>.bin.
+
+#include <stdio.h>
+#include <stdint.h>
+#include <string.h>
+#include <stdlib.h>
+#include <math.h>
+#ifdef MS_WINDOWS
+#include <process.h>
+#define memtrace__getpid _getpid
+#else
+#include <unistd.h>
+#include <fcntl.h>
+#include <pthread.h>
+#include <sys/mman.h>
+#define memtrace__getpid getpid
+#endif
+
+#define MEMTRACE_MAGIC "PMEMTRC2"
+#define MEMTRACE_STRING 0
+#define MEMTRACE_BUFFER_SIZE (64 * 1024)
+#define MEMTRACE_CAPSULE "promisedio.memtrace"
+
+typedef struct {
+    uint64_t timestamp;
+    uint64_t ptr;
+    uint32_t action;
+    uint32_t type;
+    uint32_t site;
+    uint32_t extra;
+} memtrace_record;
+
+typedef struct {
+    char magic[8];
+    uint32_t record_size;
+    uint32_t pid;
+    uint64_t sample_rate;
+} memtrace_header;
+
+typedef struct {
+    const void *a;
+    const void *b;
+    int line;
+    uint32_t id;
+} memtrace_key;
+
+typedef struct {
+#ifdef MS_WINDOWS
+    FILE *fp;
+#else
+    int fd;
+    off_t offset;  // file offset of the mapped window
+#endif
+    int pid;       // owner process
+    char *buffer;  // NULL if the trace file is closed
+    size_t pos;
+    memtrace_key *keys;
+    size_t capacity;
+    size_t used;
+    uint32_t next_id;
+    // sampling: open addressing set of sampled pointers, 0 - empty, 1 - deleted
+    uint64_t sample_rate;
+    int64_t bytes_until_sample;
+    uint64_t rng;
+    uintptr_t *sampled;
+    size_t sampled_capacity;
+    size_t sampled_used;  // live entries and tombstones
+    size_t sampled_live;
+#ifdef MS_WINDOWS
+    char data[MEMTRACE_BUFFER_SIZE];
+#endif
+} memtrace_state;
+
+static memtrace_state *memtrace__owned = NULL;
+
+#ifdef MS_WINDOWS
+
+Py_LOCAL_INLINE(void)
+memtrace__flush(memtrace_state *st)
+{
+    fwrite(st->buffer, 1, st->pos, st->fp);
+    st->pos = 0;
+}
+
+Py_LOCAL_INLINE(int)
+memtrace__open_file(memtrace_state *st, const char *path)
+{
+    st->fp = fopen(path, "wb");
+    if (!st->fp) {
+        return -1;
+    }
+    st->buffer = st->data;
+    st->pos = 0;
+    return 0;
+}
+
+Py_LOCAL_INLINE(void)
+memtrace__close_file(memtrace_state *st)
+{
+    memtrace__flush(st);
+    fclose(st->fp);
+    st->fp = NULL;
+    st->buffer = NULL;
+}
+
+#else
+
+Py_LOCAL_INLINE(void)
+memtrace__map(memtrace_state *st)
+{
+    void *buffer = MAP_FAILED;
+    if (ftruncate(st->fd, st->offset + MEMTRACE_BUFFER_SIZE) == 0) {
+        buffer = mmap(NULL, MEMTRACE_BUFFER_SIZE, PROT_READ | PROT_WRITE, MAP_SHARED, st->fd, st->offset);
+    }
+    st->buffer = buffer == MAP_FAILED ? NULL : (char *) buffer;
+    st->pos = 0;
+}
+
+Py_LOCAL_INLINE(void)
+memtrace__flush(memtrace_state *st)
+{
+    // move the window to the next part of the file
+    munmap(st->buffer, MEMTRACE_BUFFER_SIZE);
+    st->offset += MEMTRACE_BUFFER_SIZE;
+    memtrace__map(st);
+}
+
+Py_LOCAL_INLINE(int)
+memtrace__open_file(memtrace_state *st, const char *path)
+{
+    st->fd = open(path, O_RDWR | O_CREAT | O_TRUNC | O_CLOEXEC, 0644);
+    if (st->fd < 0) {
+        return -1;
+    }
+    st->offset = 0;
+    memtrace__map(st);
+    if (!st->buffer) {
+        close(st->fd);
+        return -1;
+    }
+    return 0;
+}
+
+Py_LOCAL_INLINE(void)
+memtrace__close_file(memtrace_state *st)
+{
+    munmap(st->buffer, MEMTRACE_BUFFER_SIZE);
+    st->buffer = NULL;
+    // drop the zeroed rest of the last window
+    if (ftruncate(st->fd, st->offset + st->pos)) {
+        // the reader stops at the first zero record anyway
+    }
+    close(st->fd);
+}
+
+#endif
+
+Py_LOCAL_INLINE(void)
+memtrace__write(memtrace_state *st, const void *data, size_t size)
+{
+    while (st->buffer && size) {
+        size_t n = MEMTRACE_BUFFER_SIZE - st->pos;
+        if (n > size) {
+            n = size;
+        }
+        memcpy(st->buffer + st->pos, data, n);
+        st->pos += n;
+        data = (const char *) data + n;
+        size -= n;
+        if (st->pos == MEMTRACE_BUFFER_SIZE) {
+            memtrace__flush(st);
+        }
+    }
+}
+
+Py_LOCAL_INLINE(void)
+memtrace__close(void)
+{
+    memtrace_state *st = memtrace__owned;
+    if (st && st->buffer) {
+        memtrace__close_file(st);
+    }
+}
+
+Py_LOCAL_INLINE(int64_t)
+memtrace__next_sample(memtrace_state *st)
+{
+    // exponentially distributed interval with mean sample_rate
+    st->rng ^= st->rng << 13;
+    st->rng ^= st->rng >> 7;
+    st->rng ^= st->rng << 17;
+    double u = ((double) (st->rng >> 11) + 1.0) / 9007199254740992.0;
+    return (int64_t) (-log(u) * (double) st->sample_rate) + 1;
+}
+
+Py_LOCAL_INLINE(void)
+memtrace__start(memtrace_state *st)
+{
+    // (Re)start the trace of the current process
+    char path[1024];
+    const char *prefix = getenv("PROMISEDIO_MEMTRACE");
+    st->pid = (int) memtrace__getpid();
+    PyOS_snprintf(path, sizeof(path), "%s.%d.bin", prefix && *prefix ? prefix : "memtrace", st->pid);
+    if (memtrace__open_file(st, path) < 0) {
+        st->buffer = NULL;
+        return;
+    }
+    st->rng = ((uint64_t) st->pid << 32) ^ (uint64_t) (uintptr_t) st ^ 0x9E3779B97F4A7C15ULL;
+    if (st->sample_rate) {
+        st->bytes_until_sample = memtrace__next_sample(st);
+    }
+    memtrace_header header = {
+        .record_size=sizeof(memtrace_record),
+        .pid=(uint32_t) st->pid,
+        .sample_rate=st->sample_rate
+    };
+    memcpy(header.magic, MEMTRACE_MAGIC, sizeof(header.magic));
+    memtrace__write(st, &header, sizeof(header));
+}
+
+#ifndef MS_WINDOWS
+static void
+memtrace__after_fork_child(void)
+{
+    memtrace_state *st = memtrace__owned;
+    if (!st || !st->buffer) {
+        return;
+    }
+    // The window and the descriptor belong to the parent's trace: drop them
+    // without writing anything, strings have to be defined again in the new file.
+    munmap(st->buffer, MEMTRACE_BUFFER_SIZE);
+    st->buffer = NULL;
+    close(st->fd);
+    if (st->keys) {
+        memset(st->keys, 0, st->capacity * sizeof(memtrace_key));
+    }
+    st->used = 0;
+    st->next_id = 0;
+    memtrace__start(st);
+}
+#endif
+
+Py_LOCAL_INLINE(memtrace_state *)
+memtrace__open(void)
+{
+    memtrace_state *st = (memtrace_state *) PyMem_RawCalloc(1, sizeof(memtrace_state));
+    if (!st) {
+        return NULL;
+    }
+    const char *sample_rate = getenv("PROMISEDIO_MEMTRACE_SAMPLE");
+    if (sample_rate && *sample_rate) {
+        st->sample_rate = strtoull(sample_rate, NULL, 10);
+    }
+    memtrace__start(st);
+    if (!st->buffer) {
+        PyMem_RawFree(st);
+        return NULL;
+    }
+    memtrace__owned = st;
+    Py_AtExit(memtrace__close);
+#ifndef MS_WINDOWS
+    pthread_atfork(NULL, NULL, memtrace__after_fork_child);
+#endif
+    return st;
+}
+
+Py_LOCAL_INLINE(memtrace_state *)
+memtrace__get(void)
+{
+    // The state is shared by all promisedio extensions of the process
+    // through the main interpreter dict.
+    static memtrace_state *state = NULL;
+    if (state) {
+        return state;
+    }
+    PyObject *exc_type, *exc_value, *exc_tb;
+    PyErr_Fetch(&exc_type, &exc_value, &exc_tb);
+    PyObject *dict = PyInterpreterState_GetDict(PyInterpreterState_Main());
+    if (dict) {
+        PyObject *capsule = PyDict_GetItemString(dict, MEMTRACE_CAPSULE);
+        if (capsule) {
+            state = (memtrace_state *) PyCapsule_GetPointer(capsule, MEMTRACE_CAPSULE);
+        } else {
+            state = memtrace__open();
+            if (state) {
+                capsule = PyCapsule_New(state, MEMTRACE_CAPSULE, NULL);
+                if (capsule) {
+                    PyDict_SetItemString(dict, MEMTRACE_CAPSULE, capsule);
+                    Py_DECREF(capsule);
+                }
+            }
+        }
+    }
+    PyErr_Clear();
+    PyErr_Restore(exc_type, exc_value, exc_tb);
+    return state;
+}
+
+Py_LOCAL_INLINE(size_t)
+memtrace__hash(const void *a, const void *b, int line)
+{
+    size_t h = (size_t) a;
+    h = h * 1000003 ^ (size_t) b;
+    h = h * 1000003 ^ (size_t) line;
+    return h ^ (h >> 16);
+}
+
+Py_LOCAL_INLINE(int)
+memtrace__grow(memtrace_state *st)
+{
+    size_t capacity = st->capacity ? st->capacity * 2 : 1024;
+    memtrace_key *keys = (memtrace_key *) PyMem_RawCalloc(capacity, sizeof(memtrace_key));
+    if (!keys) {
+        return -1;
+    }
+    for (size_t i = 0; i < st->capacity; ++i) {
+        memtrace_key *key = &st->keys[i];
+        if (key->a) {
+            size_t j = memtrace__hash(key->a, key->b, key->line) & (capacity - 1);
+            while (keys[j].a) {
+                j = (j + 1) & (capacity - 1);
+            }
+            keys[j] = *key;
+        }
+    }
+    PyMem_RawFree(st->keys);
+    st->keys = keys;
+    st->capacity = capacity;
+    return 0;
+}
+
+Py_LOCAL_INLINE(uint32_t)
+memtrace__intern(memtrace_state *st, const char *a, const char *b, int line)
+{
+    if (st->used * 2 >= st->capacity && memtrace__grow(st) < 0) {
+        return 0;
+    }
+    size_t mask = st->capacity - 1;
+    size_t i = memtrace__hash(a, b, line) & mask;
+    while (st->keys[i].a) {
+        memtrace_key *key = &st->keys[i];
+        if (key->a == a && key->b == b && key->line == line) {
+            return key->id;
+        }
+        i = (i + 1) & mask;
+    }
+    uint32_t id = ++st->next_id;
+    st->keys[i] = (memtrace_key) {.a=a, .b=b, .line=line, .id=id};
+    ++st->used;
+
+    char text[512];
+    size_t size;
+    if (b) {
+        const char *filename = strrchr(a, '/');
+#ifdef MS_WINDOWS
+        if (!filename) {
+            filename = strrchr(a, '\\');
+        }
+#endif
+        filename = filename ? filename + 1 : a;
+        PyOS_snprintf(text, sizeof(text), "%s:%d, %s", filename, line, b);
+        size = strlen(text);
+    } else {
+        size = strlen(a);
+        if (size > sizeof(text)) {
+            size = sizeof(text);
+        }
+        memcpy(text, a, size);
+    }
+    memtrace_record record = {.action=MEMTRACE_STRING, .type=id, .extra=(uint32_t) size};
+    memtrace__write(st, &record, sizeof(record));
+    // payload is padded up to a whole number of records
+    char payload[sizeof(text) + sizeof(memtrace_record)] = {0};
+    memcpy(payload, text, size);
+    size = (size + sizeof(memtrace_record) - 1) / sizeof(memtrace_record) * sizeof(memtrace_record);
+    memtrace__write(st, payload, size);
+    return id;
+}
+
+Py_LOCAL_INLINE(size_t)
+memtrace__ptr_slot(memtrace_state *st, uintptr_t ptr, int insert)
+{
+    size_t mask = st->sampled_capacity - 1;
+    size_t i = memtrace__hash((void *) ptr, NULL, 0) & mask;
+    size_t slot = (size_t) -1;
+    while (st->sampled[i]) {
+        if (st->sampled[i] == ptr) {
+            return i;
+        }
+        if (insert && st->sampled[i] == 1 && slot == (size_t) -1) {
+            slot = i;
+        }
+        i = (i + 1) & mask;
+    }
+    if (!insert) {
+        return (size_t) -1;
+    }
+    return slot != (size_t) -1 ? slot : i;
+}
+
+Py_LOCAL_INLINE(int)
+memtrace__ptr_rehash(memtrace_state *st)
+{
+    // The table is half full. It doubles only if live entries take a quarter
+    // of it, otherwise it is rebuilt at the same size without the tombstones,
+    // so its size follows the live sampled blocks, not all addresses ever sampled.
+    size_t old_capacity = st->sampled_capacity;
+    uintptr_t *old = st->sampled;
+    size_t capacity = old_capacity;
+    if (!capacity) {
+        capacity = 1024;
+    } else if (st->sampled_live * 4 >= old_capacity) {
+        capacity = old_capacity * 2;
+    }
+    uintptr_t *sampled = (uintptr_t *) PyMem_RawCalloc(capacity, sizeof(uintptr_t));
+    if (!sampled) {
+        return -1;
+    }
+    st->sampled = sampled;
+    st->sampled_capacity = capacity;
+    st->sampled_used = 0;
+    for (size_t i = 0; i < old_capacity; ++i) {
+        if (old[i] > 1) {
+            st->sampled[memtrace__ptr_slot(st, old[i], 1)] = old[i];
+            ++st->sampled_used;
+        }
+    }
+    PyMem_RawFree(old);
+    return 0;
+}
+
+Py_LOCAL_INLINE(void)
+memtrace__ptr_add(memtrace_state *st, uintptr_t ptr)
+{
+    if (st->sampled_used * 2 >= st->sampled_capacity && memtrace__ptr_rehash(st) < 0) {
+        return;
+    }
+    size_t i = memtrace__ptr_slot(st, ptr, 1);
+    if (st->sampled[i] != ptr) {
+        if (st->sampled[i] == 0) {
+            ++st->sampled_used;
+        }
+        ++st->sampled_live;
+        st->sampled[i] = ptr;
+    }
+}
+
+Py_LOCAL_INLINE(int)
+memtrace__ptr_discard(memtrace_state *st, uintptr_t ptr)
+{
+    if (!st->sampled_capacity) {
+        return 0;
+    }
+    size_t i = memtrace__ptr_slot(st, ptr, 0);
+    if (i == (size_t) -1) {
+        return 0;
+    }
+    st->sampled[i] = 1;
+    --st->sampled_live;
+    return 1;
+}
+
+Py_LOCAL_INLINE(int)
+memtrace__ptr_contains(memtrace_state *st, uintptr_t ptr)
+{
+    return st->sampled_capacity && memtrace__ptr_slot(st, ptr, 0) != (size_t) -1;
+}
+
+Py_LOCAL_INLINE(int)
+memtrace__sample(memtrace_state *st, const char *action, uintptr_t ptr, size_t size)
+{
+    if (ptr <= 1) {
+        return 0;
+    }
+    if (size) {
+        // allocation event
+        st->bytes_until_sample -= (int64_t) size;
+        if (st->bytes_until_sample > 0) {
+            memtrace__ptr_discard(st, ptr);
+            return 0;
+        }
+        st->bytes_until_sample = memtrace__next_sample(st);
+        memtrace__ptr_add(st, ptr);
+        return 1;
+    }
+    if (strcmp(action, "Free") == 0 || strcmp(action, "Delete") == 0) {
+        return memtrace__ptr_discard(st, ptr);
+    }
+    return memtrace__ptr_contains(st, ptr);
+}
+
+Py_LOCAL_INLINE(void)
+Memtrace_Log(const char *action, void *ptr, const char *type, size_t size,
+             const char *file, int line, const char *func)
+{
+    memtrace_state *st = memtrace__get();
+    if (!st || !st->buffer) {
+        return;
+    }
+    if (st->sample_rate && !memtrace__sample(st, action, (uintptr_t) ptr, size)) {
+        return;
+    }
+    memtrace_record record = {
+        .timestamp=(uint64_t) _PyTime_GetMonotonicClock(),
+        .ptr=(uint64_t) (uintptr_t) ptr,
+        .action=memtrace__intern(st, action, NULL, 0),
+        .type=memtrace__intern(st, type, NULL, 0),
+        .site=memtrace__intern(st, file, func, line),
+        .extra=size > UINT32_MAX ? UINT32_MAX : (uint32_t) size,
+    };
+    memtrace__write(st, &record, sizeof(record));
+}
+
+#endif
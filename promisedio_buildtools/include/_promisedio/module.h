@@ -22,9 +22,58 @@ _CTX__gettype(PyTypeObject *obj)
     return _CTX__getmodule(((PyHeapTypeObject *) obj)->ht_module);
 }
 
+#ifdef Py_TPFLAGS_VALID_VERSION_TAG
+#define _CTX__has_version_tag(type) PyType_HasFeature(type, Py_TPFLAGS_VALID_VERSION_TAG)
+#else
+#define _CTX__has_version_tag(type) ((type)->tp_version_tag != 0)
+#endif
+
+#if PY_VERSION_HEX >= 0x030B0000
+#define _CTX__GetModuleByDef PyType_GetModuleByDef
+#else
+#define _CTX__GetModuleByDef _PyType_GetModuleByDef
+#endif
+
+#define _CTX_SUBTYPE_CACHE_SIZE 64
+
+typedef struct {
+    PyTypeObject *type;
+    unsigned int version;
+    PyModuleDef *def;
+    void *state;
+} _ctx_subtype_cache_entry;
+
+// A type gets a new version tag when it is modified or when its memory is
+// reused by another type, so (type, version, def) identifies a subtype
+// without keeping a reference to it. The type pointer is part of the key
+// because since 3.12 heap types of different interpreters may share tags.
+static _ctx_subtype_cache_entry _ctx__subtype_cache[_CTX_SUBTYPE_CACHE_SIZE];
+
+Py_LOCAL_INLINE(void *)
+_CTX__getsubtype(PyTypeObject *type, PyModuleDef *def)
+{
+    if (!_CTX__has_version_tag(type)) {
+        return _CTX__getmodule(_CTX__GetModuleByDef(type, def));
+    }
+    unsigned int version = type->tp_version_tag;
+    _ctx_subtype_cache_entry *entry = &_ctx__subtype_cache[version % _CTX_SUBTYPE_CACHE_SIZE];
+    if (entry->state && entry->type == type && entry->version == version && entry->def == def) {
+        return entry->state;
+    }
+    PyObject *module = _CTX__GetModuleByDef(type, def);
+    if (!module) {
+        return NULL;
+    }
+    entry->type = type;
+    entry->version = version;
+    entry->def = def;
+    entry->state = _CTX__getmodule(module);
+    return entry->state;
+}
+
 #define _CTX_get_module(module) ((_modulestate *) _CTX__getmodule(module))
 #define _CTX_set_module(module) _ctx_var = _CTX_get_module(module)
-#define _CTX_get_subtype(type, module) _CTX_get_module(_PyType_GetModuleByDef(type, module))
+#define _CTX_get_subtype(type, module) ((_modulestate *) _CTX__getsubtype(type, module))
 #define _CTX_set_subtype(type, module) _ctx_var = _CTX_get_subtype(type, module)
 #define _CTX_get_type(type) ((_modulestate *) _CTX__gettype(type))
 #define _CTX_set_type(type) _ctx_var = _CTX_get_type(type)
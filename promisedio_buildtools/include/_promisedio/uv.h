@@ -5,6 +5,7 @@
 
 #include <uv.h>
 #include "_promisedio/base.h"
+#include "_promisedio/chain.h"
 #include "_promisedio/memory.h"
 #include "_promisedio/module.h"
 
@@ -13,54 +14,123 @@
 
 typedef struct {
     void *_ctx;
+    void *_freelist;
     char base[0];
 } Request;
 
+// Fixed-size request slot, large enough for any libuv request type.
+// Modules opt in with Freelist_Raw(RequestSlab) in the module state.
+typedef char RequestSlab[sizeof(Request) + sizeof(union uv_any_req)];
+
 Py_LOCAL_INLINE(uv_req_t *)
-Request_New(void *_ctx, PyObject *promise, size_t size)
+Request__init(void *_ctx, Request *ptr, void *freelist, PyObject *promise)
 {
-    Request *ptr = (Request *) Py_Malloc(size + sizeof(Request));
-    if (!ptr) {
-        PyErr_NoMemory();
-        return NULL;
-    }
-    LOG("(%p, %zu) -> %p", promise, size, &ptr->base);
     _CTX_save(ptr);
+    ptr->_freelist = freelist;
     uv_req_t *req = (uv_req_t *) ptr->base;
     PyTrack_XINCREF(promise);
     req->data = promise;
     return req;
 }
 
-#define Request_New(type, promise) ((type *) Request_New(_ctx, (PyObject *) (promise), sizeof(type)))
+Py_LOCAL_INLINE(uv_req_t *)
+Request_New(void *_ctx, PyObject *promise, size_t size MEMLOG_SITE_PARAMS)
+{
+    Request *ptr = (Request *) (Py_Malloc)(size + sizeof(Request) MEMLOG_SITE_FORWARD);
+    if (!ptr) {
+        PyErr_NoMemory();
+        return NULL;
+    }
+    LOG("(%p, %zu) -> %p", promise, size, &ptr->base);
+    return Request__init(_ctx, ptr, NULL, promise);
+}
+
+#define Request_New(type, promise) ((type *) Request_New(_ctx, (PyObject *) (promise), sizeof(type) MEMLOG_SITE))
 #define Request_PROMISE(req) ((Promise *)((req)->data))
 #define _CTX_set_req(req) _CTX_set((Request *) container_of(req, Request));
 
+// A request type that doesn't fit a slot fails to compile, rather than overflowing it
+#define Request_SLAB_CHECK(type) Py_BUILD_ASSERT_EXPR(sizeof(type) <= sizeof(union uv_any_req))
+
+#ifndef BUILD_DISABLE_FREELISTS
+
+Py_LOCAL_INLINE(uv_req_t *)
+Request_Slab_New(void *_ctx, freelist_raw_info *fl, PyObject *promise, size_t size MEMLOG_SITE_PARAMS)
+{
+    assert(size + sizeof(Request) <= fl->obj_size);
+    Request *ptr = (Request *) (Freelist_Malloc)(fl MEMLOG_SITE_FORWARD);
+    if (!ptr) {
+        PyErr_NoMemory();
+        return NULL;
+    }
+    LOG("(%p, %zu) -> %p", promise, size, &ptr->base);
+    return Request__init(_ctx, ptr, fl, promise);
+}
+
+#define Request_Slab_New(type, promise)                                                     \
+    ((type *) Request_Slab_New(_ctx, &_ctx->RequestSlab__raw_freelist, (PyObject *) (promise),  \
+                               sizeof(type) + Request_SLAB_CHECK(type) MEMLOG_SITE))
+
+#else
+
+#define Request_Slab_New(type, promise) \
+    (TOUCH(_ctx->RequestSlab__raw_freelist), (void) Request_SLAB_CHECK(type), Request_New(type, promise))
+
+#endif
+
 Py_LOCAL_INLINE(void)
-Request_Close(uv_req_t *req)
+Request_Close(uv_req_t *req MEMLOG_SITE_PARAMS)
 {
     LOG("(%p)", req);
     PyTrack_XDECREF(req->data);
-    Py_Free(container_of(req, Request));
+    Request *ptr = container_of(req, Request);
+#ifndef BUILD_DISABLE_FREELISTS
+    if (ptr->_freelist) {
+        (Freelist_Free)((freelist_raw_info *) ptr->_freelist, ptr MEMLOG_SITE_FORWARD);
+        return;
+    }
+#endif
+    (Py_Free)(ptr MEMLOG_SITE_FORWARD);
 }
 
-#define Request_Close(req) Request_Close((uv_req_t *) (req))
+#define Request_Close(req) Request_Close((uv_req_t *) (req) MEMLOG_SITE)
 
 typedef void (*finalizer)(uv_handle_t *handle);
 
 #define HANDLE_BASE(handle_type) \
     finalizer _finalizer;        \
     void *_ctx;                  \
+    void *_close_queue;          \
+    void *Chain__NEXT_FIELD;     \
     handle_type base;
 
 typedef struct {
     HANDLE_BASE(uv_handle_t);
 } HandleBase;
 
+// Deferred close queue: close callbacks only link closed handles into the
+// chain, finalizers of the whole batch run under a single GIL acquisition
+// at the start of the next loop iteration.
+// The queue is allocated separately from the module state: the loop keeps
+// its idle handle until the close callback runs, and handles closed after
+// Handle_CloseQueue_Clear still reference it, so it is freed only when the
+// idle handle is closed and no batched handle is left.
+typedef struct {
+    uv_idle_t idle;
+    int closing;
+    int idle_closed;
+    Py_ssize_t refs;
+    Chain_ROOT(HandleBase)
+} handle_close_queue;
+
+// NULL until Handle_CloseQueue_Init succeeds, Handle_New_Batched falls back
+// to the per-handle path then.
+#define Handle_CloseQueue handle_close_queue *handle__close_queue;
+
 Py_LOCAL_INLINE(void *)
-Handle_New(void *_ctx, size_t size, size_t base_offset, finalizer cb)
+Handle_New(void *_ctx, size_t size, size_t base_offset, finalizer cb, handle_close_queue *queue MEMLOG_SITE_PARAMS)
 {
-    void *ptr = Py_Malloc(size);
+    void *ptr = (Py_Malloc)(size MEMLOG_SITE_FORWARD);
     if (!ptr) {
         PyErr_NoMemory();
         return NULL;
@@ -68,36 +138,148 @@ Handle_New(void *_ctx, size_t size, size_t base_offset, finalizer cb)
     LOG("(%zu) -> %p", size, ptr);
     HandleBase *base = (HandleBase *) ((char *) ptr + base_offset);
     base->_finalizer = cb;
+    if (queue) {
+        queue->refs++;
+    }
+    base->_close_queue = queue;
     _CTX_save(base);
     base->base.data = ptr;
     return ptr;
 }
 
 #define Handle_New(type, cb) \
-    (type *) Handle_New(_ctx, sizeof(type), offsetof(type, _finalizer), (finalizer) (cb))
+    (type *) Handle_New(_ctx, sizeof(type), offsetof(type, _finalizer), (finalizer) (cb), NULL MEMLOG_SITE)
+
+#define Handle_New_Batched(type, cb) \
+    (type *) (Handle_New)(_ctx, sizeof(type), offsetof(type, _finalizer), (finalizer) (cb), _ctx->handle__close_queue MEMLOG_SITE)
+
+Py_LOCAL_INLINE(void)
+handle__finalize(HandleBase *base)
+{
+    void *ptr = base->base.data;
+    if (base->_finalizer) {
+        base->_finalizer(ptr);
+    }
+    Py_Free(ptr);
+}
 
-#define Handle_Free(h) Py_Free(h)
+Py_LOCAL_INLINE(void)
+handle__release_queue(handle_close_queue *queue)
+{
+    // Should be called with the GIL held.
+    if (queue->closing && queue->idle_closed && !queue->refs) {
+        Py_Free(queue);
+    }
+}
+
+Py_LOCAL_INLINE(void)
+Handle_Free(void *ptr, HandleBase *base MEMLOG_SITE_PARAMS)
+{
+    // Frees a handle that libuv doesn't know about (e.g. its init failed),
+    // and releases its reference to the close queue.
+    handle_close_queue *queue = (handle_close_queue *) base->_close_queue;
+    (Py_Free)(ptr MEMLOG_SITE_FORWARD);
+    if (queue) {
+        queue->refs--;
+        handle__release_queue(queue);
+    }
+}
+
+#define Handle_Free(h) Handle_Free((h), (HandleBase *) &(h)->_finalizer MEMLOG_SITE)
+
+static void
+handle__flush_close_queue(uv_idle_t *idle)
+{
+    handle_close_queue *queue = (handle_close_queue *) idle->data;
+    HandleBase *base;
+    uv_idle_stop(idle);
+    ACQUIRE_GIL
+        Chain_PULLALL(base, queue) {
+            handle__finalize(base);
+        }
+    RELEASE_GIL
+}
+
+static void
+handle__on_close_queue(uv_handle_t *idle)
+{
+    handle_close_queue *queue = (handle_close_queue *) idle->data;
+    ACQUIRE_GIL
+        queue->idle_closed = 1;
+        handle__release_queue(queue);
+    RELEASE_GIL
+}
 
 static void
 handle__on_close(uv_handle_t *handle)
 {
+    HandleBase *base = container_of(handle, HandleBase);
+    handle_close_queue *queue = (handle_close_queue *) base->_close_queue;
+    if (queue && !queue->closing) {
+        queue->refs--;
+        if (!Chain_HEAD(queue)) {
+            uv_idle_start(&queue->idle, handle__flush_close_queue);
+        }
+        Chain_APPEND(queue, base);
+        return;
+    }
     ACQUIRE_GIL
-        HandleBase *base = container_of(handle, HandleBase);
-        if (base->_finalizer) {
-            base->_finalizer(handle->data);
+        handle__finalize(base);
+        if (queue) {
+            queue->refs--;
+            handle__release_queue(queue);
         }
-        Py_Free(handle->data);
     RELEASE_GIL
 }
 
+Py_LOCAL_INLINE(int)
+Handle_CloseQueue_Init(handle_close_queue **queue_ptr, uv_loop_t *loop)
+{
+    handle_close_queue *queue = (handle_close_queue *) Py_Malloc(sizeof(handle_close_queue));
+    if (!queue) {
+        return UV_ENOMEM;
+    }
+    memset(queue, 0, sizeof(handle_close_queue));
+    Chain_INIT(queue);
+    int ret = uv_idle_init(loop, &queue->idle);
+    if (ret) {
+        Py_Free(queue);
+        return ret;
+    }
+    queue->idle.data = queue;
+    *queue_ptr = queue;
+    return 0;
+}
+
+#define Handle_CloseQueue_Init(loop) Handle_CloseQueue_Init(&_ctx->handle__close_queue, loop)
+
+Py_LOCAL_INLINE(void)
+Handle_CloseQueue_Clear(handle_close_queue **queue_ptr)
+{
+    // Should be called with the GIL held.
+    handle_close_queue *queue = *queue_ptr;
+    HandleBase *base;
+    if (!queue) {
+        return;
+    }
+    *queue_ptr = NULL;
+    Chain_PULLALL(base, queue) {
+        handle__finalize(base);
+    }
+    // The queue is freed by the idle close callback or by the last
+    // batched handle closed after it, whichever comes last.
+    queue->closing = 1;
+    uv_close((uv_handle_t *) &queue->idle, handle__on_close_queue);
+}
+
+#define Handle_CloseQueue_Clear() Handle_CloseQueue_Clear(&_ctx->handle__close_queue)
+
 Py_LOCAL_INLINE(void)
 Handle_Close_UV(uv_handle_t *handle)
 {
     if (handle && !uv_is_closing(handle)) {
         LOG("(%p)", handle->data);
-        BEGIN_ALLOW_THREADS
         uv_close(handle, handle__on_close);
-        END_ALLOW_THREADS
     }
 }
 
@@ -114,6 +296,17 @@ Handle_Close_UV(uv_handle_t *handle)
         }                                       \
     }
 
+#define Request_SETUP_SLAB(req_type, req, promise)   \
+    req_type *(req) = NULL;                          \
+    Promise *(promise) = Promise_New();              \
+    if (promise) {                                   \
+        (req) = Request_Slab_New(req_type, promise); \
+        if (!(req)) {                                \
+            Py_DECREF(promise);                      \
+            (promise) = NULL;                        \
+        }                                            \
+    }
+
 #define Request_DESTROY(req, promise)           \
     Py_DECREF(promise);                         \
     Request_Close(req)
@@ -131,11 +324,133 @@ Handle_Close_UV(uv_handle_t *handle)
     END_ALLOW_THREADS               \
     if (uv_errno < 0)
 
+// Calls that never block: they only touch loop/handle state or submit work,
+// so releasing the GIL around them costs more than the call itself.
+//
+//   UV_CALL_FAST (keeps the GIL)          UV_CALL (releases the GIL)
+//   ----------------------------          --------------------------
+//   uv_*_init                             uv_run
+//   uv_close                              uv_fs_* with NULL callback
+//   uv_timer_start, uv_timer_stop         uv_getaddrinfo with NULL callback
+//   uv_timer_again                        uv_getnameinfo with NULL callback
+//   uv_read_start, uv_read_stop           uv_spawn
+//   uv_write, uv_try_write, uv_shutdown   uv_pipe_bind
+//   uv_tcp_nodelay, uv_tcp_keepalive      uv_loop_close
+//   uv_tcp_bind, uv_tcp_connect
+//   uv_listen, uv_accept
+//   uv_async_send
+//   uv_fs_* with callback
+//   uv_getaddrinfo with callback
+
+#define UV_CALL_FAST(func, ...)     \
+    int uv_errno;                   \
+    uv_errno = func(__VA_ARGS__);   \
+    if (uv_errno < 0)
+
+#define UV_CALL_NOGIL UV_CALL_FAST
+
+
+// Errors that happen at high rates under load get their exception arguments
+// prebuilt once per module, instead of a fresh tuple and str on each error.
+#define UVERROR_CACHE_MAP(XX)   \
+    XX(EOF)                     \
+    XX(EAGAIN)                  \
+    XX(ECANCELED)               \
+    XX(ECONNRESET)              \
+    XX(ECONNREFUSED)            \
+    XX(ECONNABORTED)            \
+    XX(EPIPE)                   \
+    XX(ETIMEDOUT)               \
+    XX(ENOENT)                  \
+    XX(EBADF)
+
+enum {
+#define XX(code) UVERROR_CACHE_##code,
+    UVERROR_CACHE_MAP(XX)
+#undef XX
+    UVERROR_CACHE_SIZE
+};
+
+typedef struct {
+    PyObject *args[UVERROR_CACHE_SIZE];
+} uverror_cache;
+
+#define UVError_Cache uverror_cache uverror__cache;
+
+Py_LOCAL_INLINE(int)
+uverror__index(int uverr)
+{
+    switch (uverr) {
+#define XX(code) case UV_##code: return UVERROR_CACHE_##code;
+        UVERROR_CACHE_MAP(XX)
+#undef XX
+        default:
+            return -1;
+    }
+}
+
+Py_LOCAL_INLINE(PyObject *)
+uverror__build_args(int uverr)
+{
+    return Py_BuildValue("(is)", uverr, uv_strerror(uverr));
+}
 
 Py_LOCAL_INLINE(PyObject *)
-Py_NewUVError(PyObject *exc, int uverr)
+UVError_Args(uverror_cache *cache, int uverr)
+{
+    if (cache) {
+        int index = uverror__index(uverr);
+        if (index >= 0 && cache->args[index]) {
+            Py_INCREF(cache->args[index]);
+            return cache->args[index];
+        }
+    }
+    return uverror__build_args(uverr);
+}
+
+Py_LOCAL_INLINE(int)
+UVError_Cache_Init(uverror_cache *cache)
 {
-    PyObject *args = Py_BuildValue("(is)", uverr, uv_strerror(uverr));
+    static const int codes[] = {
+#define XX(code) UV_##code,
+        UVERROR_CACHE_MAP(XX)
+#undef XX
+    };
+    for (int i = 0; i < UVERROR_CACHE_SIZE; ++i) {
+        PyObject *code = PyLong_FromLong(codes[i]);
+        if (!code) {
+            return -1;
+        }
+        PyObject *msg = PyUnicode_InternFromString(uv_strerror(codes[i]));
+        if (!msg) {
+            Py_DECREF(code);
+            return -1;
+        }
+        cache->args[i] = PyTuple_Pack(2, code, msg);
+        Py_DECREF(code);
+        Py_DECREF(msg);
+        if (!cache->args[i]) {
+            return -1;
+        }
+    }
+    return 0;
+}
+
+Py_LOCAL_INLINE(void)
+UVError_Cache_Clear(uverror_cache *cache)
+{
+    for (int i = 0; i < UVERROR_CACHE_SIZE; ++i) {
+        Py_CLEAR(cache->args[i]);
+    }
+}
+
+#define UVError_Cache_Init() UVError_Cache_Init(&_ctx->uverror__cache)
+#define UVError_Cache_Clear() UVError_Cache_Clear(&_ctx->uverror__cache)
+
+Py_LOCAL_INLINE(PyObject *)
+Py_NewUVError(PyObject *exc, int uverr, uverror_cache *cache)
+{
+    PyObject *args = UVError_Args(cache, uverr);
     PyObject *ret = NULL;
     if (args) {
         ret = PyObject_CallOneArg(exc, args);
@@ -145,18 +460,24 @@ Py_NewUVError(PyObject *exc, int uverr)
     return ret;
 }
 
+#define Py_NewUVError(exc, uverr) Py_NewUVError(exc, uverr, NULL)
+#define Py_NewUVErrorCached(exc, uverr) (Py_NewUVError)(exc, uverr, &_ctx->uverror__cache)
+
 Py_LOCAL_INLINE(void)
-Py_SetUVError(PyObject *exc, int uverr)
+Py_SetUVError(PyObject *exc, int uverr, uverror_cache *cache)
 {
-    PyObject *args = Py_BuildValue("(is)", uverr, uv_strerror(uverr));
+    PyObject *args = UVError_Args(cache, uverr);
     if (args != NULL) {
         PyErr_SetObject(exc, args);
         Py_DECREF(args);
     }
 }
 
-#define Promise_RejectUVError(promise, exc, uverr) {                    \
-    PyObject *_args = Py_BuildValue("(is)", uverr, uv_strerror(uverr)); \
+#define Py_SetUVError(exc, uverr) Py_SetUVError(exc, uverr, NULL)
+#define Py_SetUVErrorCached(exc, uverr) (Py_SetUVError)(exc, uverr, &_ctx->uverror__cache)
+
+#define Promise__RejectUVError(promise, exc, uverr, cache) {            \
+    PyObject *_args = UVError_Args(cache, uverr);                       \
     if (!_args) {                                                       \
         Promise_Reject(promise, NULL);                                  \
     } else {                                                            \
@@ -165,4 +486,9 @@ Py_SetUVError(PyObject *exc, int uverr)
     Py_XDECREF(_args);                                                  \
 }
 
+#define Promise_RejectUVError(promise, exc, uverr) \
+    Promise__RejectUVError(promise, exc, uverr, NULL)
+#define Promise_RejectUVErrorCached(promise, exc, uverr) \
+    Promise__RejectUVError(promise, exc, uverr, &_ctx->uverror__cache)
+
 #endif
@@ -1,36 +1,70 @@
+import io
+import os
 import re
+import math
 import sys
+import csv
+import json
+import struct
+import argparse
+import tempfile
+import contextlib
+import concurrent.futures
 
 
 class Ref:
-    def __init__(self, type):
+    def __init__(self, type, site=None, size=0, weight=1):
         self.type = type
         self.refcnt = 1
+        self.site = site
+        self.size = size
+        # number of real allocations a sampled one stands for
+        self.weight = weight
 
     def __str__(self):
         return f"{self.type}({self.refcnt})"
 
 
-def main():
-    mallocs = []
-    objects = {}
-    types = {}
+class MemCheck:
+    """Tracks live raw allocations and objects from a MEMLOG trace.
 
-    def print_objects():
-        for addr, ref in objects.items():
+    Both live sets are dicts keyed by address, so matching an event to its
+    allocation is O(1) and reports keep allocation order.
+    """
+
+    def __init__(self, sample_every=0, timeline=False):
+        self.mallocs = {}
+        self.objects = {}
+        self.types = {}
+        self.live_bytes = 0
+        self.peak_bytes = 0
+        # [live, peak] bytes per type and per call site
+        self.type_bytes = {}
+        self.site_bytes = {}
+        # live and peak counts per type, RAW for raw allocations
+        self.live_counts = {}
+        self.peak_counts = {}
+        self.events = 0
+        self.timestamp = None
+        self.sample_every = sample_every
+        self.timeline = [] if timeline or sample_every else None
+
+    def print_objects(self):
+        for addr, ref in self.objects.items():
             print(f"{addr}\t{ref}")
 
-    def print_mallocs():
-        for addr in mallocs:
-            if addr in objects:
-                print(f"{addr}\t{objects[addr]}")
+    def print_mallocs(self):
+        for addr in self.mallocs:
+            if addr in self.objects:
+                print(f"{addr}\t{self.objects[addr]}")
             else:
                 print(f"{addr}\tRAW")
 
-    def print_types():
-        for tp in types:
-            print(f"{tp} new:{types[tp]['new']} del:{types[tp]['del']}")
+    def print_types(self):
+        for tp in self.types:
+            print(f"{tp} new:{round(self.types[tp]['new'])} del:{round(self.types[tp]['del'])}")
 
+    @staticmethod
     def print_header(title):
         length = 40
         if not title:
@@ -41,90 +75,508 @@ def main():
         right_pad = rest - left_pad
         print("=" * left_pad, title, "=" * right_pad)
 
-    def print_stats():
-        print_header("Mallocs")
-        print_mallocs()
-        print_header("Objects")
-        print_objects()
-        print_header("Types")
-        print_types()
-
-    def print_leaks():
-        if objects:
-            print_header("Leaks report (Objects)")
-            print_objects()
-        if mallocs:
-            print_header("Leaks report (Mallocs)")
-            print_mallocs()
-        if not (objects and mallocs):
-            print_header("Great! No leaks")
-        if types:
-            print_types()
-
-    for line in sys.stdin:
-        line = line.strip()
-        print(line)
-        if not line:
-            continue
-        if line == "#ALLOCSTAT":
-            print_stats()
-            continue
-        if not line.startswith("#"):
-            continue
-        match = re.match(r"#(\w+)\s*\((.*)\)", line.split("--", 1)[0].strip())
-        if not match:
-            continue
-        action, args = match.groups()
-        args = [x.strip() for x in args.split(",")]
+    def sample(self):
+        if self.timeline and self.timeline[-1][0] == self.events:
+            return
+        live = {tp: round(count) for tp, count in self.live_counts.items()}
+        self.timeline.append((self.events, self.timestamp, live))
+
+    def write_timeline(self, path):
+        types = sorted(self.peak_counts)
+        if path.endswith(".json"):
+            data = {
+                "samples": [
+                    {"event": event, "timestamp": timestamp, "live": live}
+                    for event, timestamp, live in self.timeline
+                ],
+                "peak": {tp: round(count) for tp, count in self.peak_counts.items()},
+            }
+            with open(path, "wt") as f:
+                json.dump(data, f, indent=2)
+            return
+        with open(path, "wt", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["event", "timestamp"] + types)
+            for event, timestamp, live in self.timeline:
+                writer.writerow([event, timestamp or ""] + [live.get(tp, 0) for tp in types])
+            writer.writerow(["peak", ""] + [round(self.peak_counts[tp]) for tp in types])
+
+    def print_stats(self):
+        if self.timeline is not None:
+            self.sample()
+        self.print_header("Mallocs")
+        self.print_mallocs()
+        self.print_header("Objects")
+        self.print_objects()
+        self.print_header("Types")
+        self.print_types()
+        if self.peak_bytes:
+            self.print_header("Memory")
+            self.print_bytes()
+
+    def leaks_by_site(self):
+        sites = {}
+        for ref in self.objects.values():
+            counts = sites.setdefault(ref.site, {})
+            counts[ref.type] = counts.get(ref.type, 0) + ref.weight
+        for addr, ref in self.mallocs.items():
+            if addr not in self.objects:
+                counts = sites.setdefault(ref.site, {})
+                counts["RAW"] = counts.get("RAW", 0) + ref.weight
+        return sorted(sites.items(), key=lambda x: sum(x[1].values()), reverse=True)
+
+    def print_sites(self):
+        for site, counts in self.leaks_by_site():
+            names = ", ".join(f"{tp}:{round(count)}" for tp, count in counts.items())
+            print(f"{round(sum(counts.values()))}\t{site or '?'}\t{names}")
+
+    def print_bytes(self):
+        print(f"live:{round(self.live_bytes)}B peak:{round(self.peak_bytes)}B")
+        self.print_header("Bytes by type")
+        for tp, (live, peak) in sorted(self.type_bytes.items(), key=lambda x: x[1][1], reverse=True):
+            print(f"{tp} live:{round(live)}B peak:{round(peak)}B")
+        self.print_header("Bytes by call site")
+        for site, (live, peak) in sorted(self.site_bytes.items(), key=lambda x: x[1][1], reverse=True):
+            print(f"{site or '?'} live:{round(live)}B peak:{round(peak)}B")
+
+    def print_leaks(self):
+        if self.objects:
+            self.print_header("Leaks report (Objects)")
+            self.print_objects()
+        if self.mallocs:
+            self.print_header("Leaks report (Mallocs)")
+            self.print_mallocs()
+        if self.objects or self.mallocs:
+            self.print_header("Leaks by call site")
+            self.print_sites()
+        if not (self.objects and self.mallocs):
+            self.print_header("Great! No leaks")
+        if self.types:
+            self.print_types()
+        if self.peak_bytes:
+            self.print_header("Memory")
+            self.print_bytes()
+
+    def print_error(self, title, action, args, live):
+        self.print_header(title)
+        print(action)
+        print(args)
+        print(live)
+        self.print_header("")
+
+    def count_type(self, tp, key, weight=1):
+        counters = self.types.get(tp)
+        if counters is None:
+            counters = self.types[tp] = {"new": 0, "del": 0}
+        counters[key] += weight
+
+    def merge(self, label, other):
+        """Fold another process into this one, prefixing addresses with label."""
+        for addr, ref in other.objects.items():
+            self.objects[f"{label}:{addr}"] = ref
+        for addr, ref in other.mallocs.items():
+            self.mallocs[f"{label}:{addr}"] = ref
+        for tp, counters in other.types.items():
+            merged = self.types.setdefault(tp, {"new": 0, "del": 0})
+            merged["new"] += counters["new"]
+            merged["del"] += counters["del"]
+        # peaks of different processes are summed: an upper bound of the total
+        self.live_bytes += other.live_bytes
+        self.peak_bytes += other.peak_bytes
+        for table, other_table in ((self.type_bytes, other.type_bytes), (self.site_bytes, other.site_bytes)):
+            for key, (live, peak) in other_table.items():
+                counters = table.setdefault(key, [0, 0])
+                counters[0] += live
+                counters[1] += peak
+
+    def account(self, ref, size):
+        if not ref.size:
+            return
+        size *= ref.weight
+        self.live_bytes += size
+        if self.live_bytes > self.peak_bytes:
+            self.peak_bytes = self.live_bytes
+        for table, key in ((self.type_bytes, ref.type), (self.site_bytes, ref.site)):
+            counters = table.get(key)
+            if counters is None:
+                counters = table[key] = [0, 0]
+            counters[0] += size
+            if counters[0] > counters[1]:
+                counters[1] = counters[0]
+
+    def allocated(self, live, addr, ref):
+        live[addr] = ref
+        self.account(ref, ref.size)
+        count = self.live_counts[ref.type] = self.live_counts.get(ref.type, 0) + ref.weight
+        if count > self.peak_counts.get(ref.type, 0):
+            self.peak_counts[ref.type] = count
+
+    def released(self, live, addr):
+        ref = live.pop(addr)
+        self.account(ref, -ref.size)
+        self.live_counts[ref.type] -= ref.weight
+        return ref
+
+    def process(self, action, args, site=None, timestamp=None, weight=1):
+        self.events += 1
+        self.timestamp = timestamp
+        self.handle(action, args, site, weight)
+        if self.sample_every and self.events % self.sample_every == 0:
+            self.sample()
+
+    def handle(self, action, args, site, weight):
+        mallocs = self.mallocs
+        objects = self.objects
+        addr = args[0]
         if action == "Malloc":
-            mallocs.append(args[0])
+            size = int(args[2]) if len(args) > 2 else 0
+            self.allocated(mallocs, addr, Ref("RAW", site, size, weight))
         elif action == "Free":
-            if args[0] not in mallocs:
-                print_header("Missing memory")
-                print(action)
-                print(args)
-                print(mallocs)
-                print_header("")
+            if addr not in mallocs:
+                self.print_error("Missing memory", action, args, list(mallocs))
             else:
-                mallocs.remove(args[0])
+                self.released(mallocs, addr)
         elif action == "New":
-            if args[0] in objects:
-                print_header("Already allocated")
-                print(action)
-                print(args)
-                print(objects)
-                print_header("")
+            if addr in objects:
+                self.print_error("Already allocated", action, args, objects)
             else:
-                objects[args[0]] = Ref(args[1])
-            types.setdefault(args[1], {"new": 0, "del": 0})["new"] += 1
+                size = int(args[2]) if len(args) > 2 else 0
+                self.allocated(objects, addr, Ref(args[1], site, size, weight))
+            self.count_type(args[1], "new", weight)
         elif action == "Delete":
-            if args[0] not in objects:
-                print_header("Missing object")
-                print(action)
-                print(args)
-                print(objects)
-                print_header("")
+            if addr not in objects:
+                self.print_error("Missing object", action, args, objects)
             else:
-                del objects[args[0]]
-            types.setdefault(args[1], {"new": 0, "del": 0})["del"] += 1
+                weight = self.released(objects, addr).weight
+            self.count_type(args[1], "del", weight)
         elif action in ("Incref", "Enter", "Resized"):
-            if args[0] in objects:
-                objects[args[0]].refcnt += 1
+            ref = objects.get(addr)
+            if ref is not None:
+                ref.refcnt += 1
             else:
-                objects[args[0]] = Ref(args[1])
+                self.allocated(objects, addr, Ref(args[1], site))
         elif action in ("Decref", "Resize"):
-            if args[0] in objects:
-                objects[args[0]].refcnt -= 1
-                if objects[args[0]].refcnt == 0:
-                    del objects[args[0]]
+            ref = objects.get(addr)
+            if ref is not None:
+                ref.refcnt -= 1
+                if ref.refcnt == 0:
+                    self.released(objects, addr)
+            else:
+                self.print_error("Missing object", action, args, objects)
+
+
+LINE_PATTERN = re.compile(r"(?:\[(\d+)\]\s*)?#(\w+)\s*\((.*)\)")
+
+# Matches "[pid] #Action(args) -- site" and bare "#ALLOCSTAT" lines in a chunk
+# of raw trace (the pid tag is optional); everything that is not a "#" line
+# is skipped by the regex engine.
+CHUNK_PATTERN = re.compile(
+    rb"^[ \t]*(?:\[(\d+)\][ \t]*)?#(\w+)(?:[ \t]*\(([^\n]*?)\)[ \t]*(?:--[ \t]*([^\n]*?))?)?[ \t]*\r?$",
+    re.MULTILINE
+)
+
+CHUNK_SIZE = 1 << 20
+
+
+class Processes:
+    """MemCheck instances of the traced processes, keyed by label."""
+
+    def __init__(self, default=None, **options):
+        self.default = default
+        self.options = options
+        self.checks = {}
+
+    def get(self, pid=None):
+        label = f"pid {int(pid)}" if pid is not None else self.default
+        memcheck = self.checks.get(label)
+        if memcheck is None:
+            memcheck = self.checks[label] = MemCheck(**self.options)
+        return memcheck
+
+
+def parse_args(args):
+    return [x.strip() for x in args.split(",")]
+
+
+def read_text(processes, stream):
+    for line in stream:
+        line = line.strip()
+        print(line)
+        if not line:
+            continue
+        event, _, site = line.partition("--")
+        match = LINE_PATTERN.match(event.strip())
+        if not match:
+            if line.endswith("#ALLOCSTAT"):
+                pid = re.match(r"\[(\d+)\]", line)
+                processes.get(pid and pid.group(1)).print_stats()
+            continue
+        pid, action, args = match.groups()
+        processes.get(pid).process(action, parse_args(args), site.strip() or None)
+
+
+def read_chunks(processes, stream):
+    tail = b""
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            data = tail
+        else:
+            data = tail + chunk
+            pos = data.rfind(b"\n") + 1
+            data, tail = data[:pos], data[pos:]
+        if b"#" in data:
+            for match in CHUNK_PATTERN.finditer(data):
+                pid, action, args, site = match.groups()
+                if args is None:
+                    if action == b"ALLOCSTAT":
+                        processes.get(pid).print_stats()
+                    continue
+                processes.get(pid).process(action.decode(), parse_args(args.decode()), site and site.decode())
+        if not chunk:
+            break
+
+
+TRACE_MAGIC = b"PMEMTRC"
+TRACE_HEADERS = {
+    b"PMEMTRC1": struct.Struct("<8sII"),
+    b"PMEMTRC2": struct.Struct("<8sIIQ"),
+}
+TRACE_RECORD = struct.Struct("<QQIIII")
+
+
+def read_trace(processes, stream):
+    """Decode a binary trace written by the BUILD_DEBUG_MEM_TRACE backend.
+
+    A process that didn't exit normally leaves its last window zero-filled,
+    decoding stops at the first zero record (string ids start at 1).
+    """
+    magic = stream.read(len(TRACE_MAGIC) + 1)
+    header = TRACE_HEADERS.get(magic)
+    if not header:
+        raise ValueError("Not a memtrace file")
+    magic, record_size, pid, *rest = header.unpack(magic + stream.read(header.size - len(magic)))
+    if record_size != TRACE_RECORD.size:
+        raise ValueError("Unsupported memtrace record size")
+    sample_rate = rest[0] if rest else 0
+    weights = {}
+    memcheck = processes.get(pid)
+    strings = {0: "?"}
+    unpack_from = TRACE_RECORD.unpack_from
+    tail = b""
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        data = tail + chunk
+        end = len(data)
+        pos = 0
+        while pos + record_size <= end:
+            timestamp, ptr, action, tp, site, extra = unpack_from(data, pos)
+            if action == 0:
+                if not tp:
+                    return
+                size = -(-extra // record_size) * record_size
+                if pos + record_size + size > end:
+                    break
+                start = pos + record_size
+                strings[tp] = data[start: start + extra].decode("utf-8", "replace")
+                pos = start + size
+                continue
+            pos += record_size
+            weight = 1
+            if sample_rate and extra:
+                # an allocation of `extra` bytes is sampled with probability 1 - exp(-extra / rate)
+                weight = weights.get(extra)
+                if weight is None:
+                    weight = weights[extra] = 1 / -math.expm1(-extra / sample_rate)
+            memcheck.process(strings[action], [hex(ptr), strings[tp], extra], strings[site], timestamp, weight)
+        tail = data[pos:]
+
+
+PID_PATTERN = re.compile(rb"[ \t]*\[(\d+)\]")
+
+
+def split_processes(stream, directory):
+    """Write the lines of each process of a text trace to its own file in directory.
+
+    Lines keep their [pid] tag, so each part is labeled like its process in
+    the whole trace; untagged lines go to a part of their own. Returns the
+    paths of the parts in order of first appearance.
+    """
+    os.makedirs(directory, exist_ok=True)
+    parts = {}
+    tail = b""
+    try:
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            data = tail + chunk
+            if chunk:
+                pos = data.rfind(b"\n") + 1
+                data, tail = data[:pos], data[pos:]
+            lines = {}
+            for line in data.splitlines(keepends=True):
+                match = PID_PATTERN.match(line)
+                lines.setdefault(match and match.group(1), []).append(line)
+            for pid, part_lines in lines.items():
+                part = parts.get(pid)
+                if part is None:
+                    part = parts[pid] = open(os.path.join(directory, f"{len(parts)}.txt"), "wb")
+                part.writelines(part_lines)
+            if not chunk:
+                break
+    finally:
+        for part in parts.values():
+            part.close()
+    return [part.name for part in parts.values()]
+
+
+def is_trace_file(path):
+    with open(path, "rb") as f:
+        return f.read(len(TRACE_MAGIC)) == TRACE_MAGIC
+
+
+def analyze_file(path, options, label=None):
+    """Analyze one trace file, binary or text; returns (checks, output).
+
+    label is the name of the process of untagged events, path by default.
+    """
+    processes = Processes(default=label or path, **options)
+    output = io.StringIO()
+    with open(path, "rb") as f, contextlib.redirect_stdout(output):
+        if f.read(len(TRACE_MAGIC)) == TRACE_MAGIC:
+            f.seek(0)
+            read_trace(processes, f)
+        else:
+            f.seek(0)
+            read_chunks(processes, f)
+    return processes.checks, output.getvalue()
+
+
+def analyze_parts(parts, options, jobs):
+    """Analyze (path, label, source) parts, in worker processes unless jobs is 1."""
+    paths, labels, sources = zip(*parts) if parts else ((), (), ())
+    if jobs == 1 or len(parts) < 2:
+        results = list(map(analyze_file, paths, [options] * len(parts), labels))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(analyze_file, paths, [options] * len(parts), labels))
+    checks = {}
+    shown = set()
+    for source, (part_checks, output) in zip(sources, results):
+        if output and len(set(sources)) > 1 and source not in shown:
+            shown.add(source)
+            MemCheck.print_header(f"File {source}")
+        sys.stdout.write(output)
+        for label, memcheck in part_checks.items():
+            if label in checks:
+                label = f"{label} ({source})"
+            checks[label] = memcheck
+    return checks
+
+
+def analyze_files(paths, options, jobs):
+    """Analyze trace files, in parallel unless jobs is 1.
+
+    With jobs > 1, the processes of a text trace are also analyzed in
+    parallel: the trace is first split by its [pid] tags.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        parts = []
+        for index, path in enumerate(paths):
+            if jobs and jobs > 1 and not is_trace_file(path):
+                with open(path, "rb") as f:
+                    split = split_processes(f, os.path.join(directory, str(index)))
+                parts += [(part, path, path) for part in split]
             else:
-                print_header("Missing object")
-                print(action)
-                print(args)
-                print(objects)
-                print_header("")
+                parts.append((path, path, path))
+        return analyze_parts(parts, options, jobs)
+
+
+def analyze_stream(stream, options, jobs):
+    """Analyze a text trace read from stream, its processes in parallel."""
+    with tempfile.TemporaryDirectory() as directory:
+        split = split_processes(stream, directory)
+        return analyze_parts([(part, "<stdin>", None) for part in split], options, jobs)
+
+
+def print_merged(checks):
+    merged = MemCheck()
+    for label, memcheck in checks.items():
+        merged.merge(label, memcheck)
+    MemCheck.print_header(f"Merged report ({len(checks)} processes)")
+    if merged.objects or merged.mallocs:
+        MemCheck.print_header("Leaks by call site")
+        merged.print_sites()
+    else:
+        MemCheck.print_header("Great! No leaks")
+    if merged.types:
+        MemCheck.print_header("Types")
+        merged.print_types()
+    if merged.peak_bytes:
+        MemCheck.print_header("Memory")
+        merged.print_bytes()
+
+
+def main(params=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "files", metavar="FILE", nargs="*",
+        help="text or binary trace files (one or more processes each); stdin if omitted"
+    )
+    parser.add_argument(
+        "-q", "--quiet", "--summary-only", dest="quiet", action="store_true",
+        help="do not echo the trace, print only anomalies and reports"
+    )
+    parser.add_argument(
+        "-t", "--trace", metavar="PATH", action="append", default=[],
+        help="read a binary trace file (same as passing it as FILE)"
+    )
+    parser.add_argument(
+        "-j", "--jobs", metavar="N", type=int, default=None,
+        help="number of worker processes; with N > 1 the processes of a text trace "
+             "(file or stdin) are analyzed in parallel too, and stdin is not echoed"
+    )
+    parser.add_argument(
+        "--sample-every", metavar="N", type=int, default=0,
+        help="sample live object counts per type every N events (and at each #ALLOCSTAT); "
+             "requires --timeline"
+    )
+    parser.add_argument(
+        "--timeline", metavar="PATH",
+        help="write sampled live counts and peaks per type to PATH (.json or .csv)"
+    )
+    args = parser.parse_args(params)
+    if args.sample_every and not args.timeline:
+        parser.error("--sample-every requires --timeline")
+    options = {"sample_every": args.sample_every, "timeline": bool(args.timeline)}
+    paths = args.files + args.trace
+    if paths:
+        checks = analyze_files(paths, options, args.jobs)
+    elif args.jobs and args.jobs > 1:
+        checks = analyze_stream(sys.stdin.buffer, options, args.jobs) or {None: MemCheck(**options)}
+    else:
+        processes = Processes(**options)
+        if args.quiet:
+            read_chunks(processes, sys.stdin.buffer)
+        else:
+            read_text(processes, sys.stdin)
+        checks = processes.checks or {None: MemCheck(**options)}
 
-    print_leaks()
+    for label, memcheck in checks.items():
+        if len(checks) > 1:
+            MemCheck.print_header(f"Process {label}")
+        if args.timeline:
+            memcheck.sample()
+            path = args.timeline
+            if len(checks) > 1:
+                root, ext = os.path.splitext(path)
+                suffix = re.sub(r"[^\w.-]+", "_", str(label))
+                path = f"{root}.{suffix}{ext}"
+            memcheck.write_timeline(path)
+        memcheck.print_leaks()
+    if len(checks) > 1:
+        print_merged(checks)
 
 
 if __name__ == "__main__":